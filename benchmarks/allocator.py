@@ -0,0 +1,84 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Container ip allocation on a nearly full subnet, bitmap against the old random probe"""
+
+# Fills one subnet to the given occupancy then churns it: release a random allocated address, allocate another.
+# The old allocator probed random addresses against a set of dotted strings, so is run the same way for comparison.
+# Run from the repository root: python3 benchmarks/allocator.py [--occupied 59000] [--churn 100000]
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model.addresses import IpAllocations, SubnetAllocator
+
+
+class RandomProbe:
+    """How Model.next_ip used to allocate"""
+    def __init__(self):
+        self.allocations = set()
+
+    def allocate(self, subnet_id):
+        smallest = subnet_id * 65536 + SubnetAllocator.first
+        biggest = smallest + SubnetAllocator.capacity
+        ip = None
+        while ip is None or ip in self.allocations:
+            n = random.randrange(smallest, biggest)
+            ip = "10.%d.%d.%d" % (n // 65536, (n // 256) % 256, n % 256)
+        self.allocations.add(ip)
+        return ip
+
+    def release(self, ip):
+        self.allocations.remove(ip)
+
+
+def run(allocator, occupied, churn, subnet_id=1):
+    random.seed(1)
+    start = time.perf_counter()
+    live = [allocator.allocate(subnet_id) for _ in range(occupied)]
+    fill = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(churn):
+        idx = random.randrange(len(live))
+        allocator.release(live[idx])
+        live[idx] = allocator.allocate(subnet_id)
+    pairs = time.perf_counter() - start
+    return fill, pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--occupied', type=int, default=59000, help="addresses held while churning")
+    parser.add_argument('--churn', type=int, default=100000, help="release and allocate pairs")
+    args = parser.parse_args()
+    if args.occupied >= SubnetAllocator.capacity:
+        parser.error("a subnet only has %d addresses" % SubnetAllocator.capacity)
+
+    print("%d of %d addresses (%.1f%%), %d release/allocate pairs" %
+          (args.occupied, SubnetAllocator.capacity, 100 * args.occupied / SubnetAllocator.capacity, args.churn))
+    for name, allocator in (('bitmap', IpAllocations()), ('random probe', RandomProbe())):
+        fill, pairs = run(allocator, args.occupied, args.churn)
+        print("%-13s fill %.3fs (%.2fus/alloc)  churn %.3fs (%.2fus/pair)" %
+              (name, fill, 1e6 * fill / args.occupied, pairs, 1e6 * pairs / args.churn))
+        if isinstance(allocator, IpAllocations):
+            state = allocator.subnets[1].state()
+            print("%-13s free_runs=%d largest_free_run=%d fragmentation=%.3f" %
+                  ('', state['free_runs'], state['largest_free_run'], state['fragmentation']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Per recipient cost of Broker.broadcast_cmd to many encrypted sessions, and whether each stays in order"""
+
+# Runs against messidge's encryption process (a real one) and a zmq ROUTER socket. Before each broadcast, some
+# sessions are sent a message through send_cmd that will still be in the encryption process when the broadcast
+# starts - and each session should get that before the broadcast. Compared are:
+#   broadcast_cmd  - everything in the encryption process is emitted, then a secretbox each on the loop
+#   send_cmd each  - each message through the encryption process, emitting what has come back as it goes
+#   unordered      - a secretbox each on the loop without waiting for the encryption process, as it used to be
+# Reported are the time the loop spends in the call and the time until the last message reached the socket. No
+# clients are connected, so zmq drops the messages - the cost of actually sending them is the same for all three.
+# Run from the repository root: python3 benchmarks/broadcast.py [--sessions 10000] [--repeat 5]
+
+import os
+import sys
+import time
+import argparse
+import cbor
+import zmq
+import libnacl
+import libnacl.utils
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from messidge.broker.agent import Agent
+from messidge.broker.broker import Broker as BrokerBase
+from broker import Broker
+
+
+class RecordingSocket:
+    def __init__(self, skt):
+        self.skt = skt
+        self.sent = []
+
+    def send_multipart(self, parts):
+        self.skt.send_multipart(parts)
+        self.sent.append(parts)
+
+
+class Fanout:
+    """The parts of the broker that broadcast_cmd uses"""
+    send_cmd = BrokerBase.send_cmd
+    broadcast_cmd = Broker.broadcast_cmd
+    _emit_all_encrypted = Broker._emit_all_encrypted
+    marker_rid = Broker.marker_rid
+    marker_key = Broker.marker_key
+
+    def __init__(self, sessions):
+        self.agent = Agent()
+        self.context = zmq.Context()
+        self.router = self.context.socket(zmq.ROUTER)
+        self.router.bind('inproc://broadcast')
+        self.skt = RecordingSocket(self.router)
+        self.rid_session_key = {n.to_bytes(4, 'big'): libnacl.utils.salsa_key() for n in range(sessions)}
+        self.model = SimpleNamespace(sessions=dict.fromkeys(self.rid_session_key))
+        self.node_rid_pk = {}
+
+    def _emit_encrypted(self, fd):
+        # as Broker._emit_encrypted, which calls the base class
+        if self.agent.encrypt_pipe[0].poll():
+            BrokerBase._emit_encrypted(self, fd)
+
+    def wait_for(self, count):
+        # what the loop would do once the broadcast had returned
+        encrypted = self.agent.encrypt_pipe[0]
+        while len(self.skt.sent) < count and encrypted.poll(5):
+            self._emit_encrypted(encrypted.fileno())
+
+    def stop(self):
+        self.agent.stop()
+        self.agent.join()
+        self.router.close()
+        self.context.term()
+
+
+def send_cmd_each(fanout, command, params):
+    encrypted = fanout.agent.encrypt_pipe[0]
+    for rid in list(fanout.model.sessions.keys()):
+        fanout.send_cmd(rid, command, params)
+        while encrypted.poll():
+            fanout._emit_encrypted(encrypted.fileno())
+    return len(fanout.model.sessions)
+
+
+def unordered(fanout, command, params):
+    # how broadcast_cmd used to do it: serialise once, then a secretbox per session straight onto the socket
+    params_binary = cbor.dumps(params)
+    for rid in list(fanout.model.sessions.keys()):
+        session_key = fanout.rid_session_key[rid]
+        nonce = libnacl.utils.rand_nonce()
+        encrypted = libnacl.crypto_secretbox(params_binary, nonce, session_key)
+        fanout.skt.send_multipart((rid, cbor.dumps((nonce, command, b'', encrypted, b''))))
+    return len(fanout.model.sessions)
+
+
+def out_of_order(sent, earlier):
+    # sessions that got the broadcast before the message sent to them earlier
+    seen = set()
+    wrong = 0
+    for rid, binary in sent:
+        if cbor.loads(binary)[1] == b'earlier':
+            wrong += 1 if rid in seen else 0
+        else:
+            seen.add(rid)
+    return wrong
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--earlier', type=int, default=200, help="sessions sent a message just before each broadcast")
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    fanout = Fanout(args.sessions)
+    command = b'update_stats'
+    params = {'node': b'x' * 43, 'stats': {'cpu': 1234, 'memory': 5678, 'paging': 0, 'ave_start_time': 2.5}}
+    earlier = list(fanout.rid_session_key.keys())[-args.earlier:]  # the end, so the broadcast gets to them last
+    try:
+        print("%d encrypted sessions, %d sent a message just before the broadcast" % (args.sessions, args.earlier))
+        for name, fn in (('broadcast_cmd', Fanout.broadcast_cmd), ('send_cmd each', send_cmd_each),
+                         ('unordered', unordered)):
+            in_call = []
+            total = []
+            wrong = 0
+            for _ in range(args.repeat):
+                fanout.skt.sent = []
+                for rid in earlier:
+                    fanout.send_cmd(rid, b'earlier', {})
+                start = time.perf_counter()
+                sent = fn(fanout, command, params)
+                in_call.append(time.perf_counter() - start)
+                fanout.wait_for(sent + len(earlier))
+                total.append(time.perf_counter() - start)
+                if len(fanout.skt.sent) != sent + len(earlier):
+                    raise RuntimeError("%s only sent %d message(s)" % (name, len(fanout.skt.sent)))
+                wrong += out_of_order(fanout.skt.sent, earlier)
+            print("%-14s on the loop %.2fus/recipient (%.1fms)  until sent %.2fus/recipient (%.1fms)  "
+                  "out of order %d/%d" %
+                  (name, 1e6 * min(in_call) / args.sessions, 1e3 * min(in_call),
+                   1e6 * min(total) / args.sessions, 1e3 * min(total), wrong, args.earlier * args.repeat))
+    finally:
+        fanout.stop()
+
+
+if __name__ == '__main__':
+    main()
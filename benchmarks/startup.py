@@ -0,0 +1,103 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Model startup time, cold (from the databases) and warm (from a snapshot)"""
+
+# Persists the given number of sessions, each with some containers and a tunnel, into databases in a temporary
+# directory then times constructing the Model: once with no snapshot, then restarting several times from the
+# snapshot the previous shutdown wrote. Every warm start has to actually load the snapshot - anything written to
+# the databases between the snapshot and the next start (a migration, say) would make it stale.
+# zfs isn't asked about volumes, Volume.all is replaced so this measures the model alone.
+# Run from the repository root: python3 benchmarks/startup.py [--sessions 10000] [--shared]
+
+import os
+import sys
+import time
+import shutil
+import logging
+import argparse
+import tempfile
+import cbor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model.model import Model
+from controller.volumes import Volume
+
+
+def populate(state, local, sessions, containers):
+    model = Model(state, local)
+    db = model.state_db
+    for s in range(sessions):
+        rid = s.to_bytes(4, 'big')
+        pk = (s % 1000).to_bytes(32, 'big')  # so users have several sessions
+        db.mutate("INSERT INTO session_users (rid, pk) VALUES (?, ?)", (rid, pk))
+        for c in range(containers):
+            n = s * containers + c
+            uuid = b'ctr-%012d' % n
+            ctr = {'user': pk, 'uuid': uuid, 'tag': None, 'session': rid, 'node_pk': b'node-%d' % (n % 20),
+                   'ip': "10.%d.%d.%d" % (2 + n % 20, 1 + (n // 20) // 256, (n // 20) % 256), 'volumes': []}
+            db.mutate("INSERT INTO session_containers (uuid, rid, cbor) VALUES (?, ?, ?)", (uuid, rid, cbor.dumps(ctr)))
+        tunnel = {'uuid': b'tun-%012d' % s, 'ip': ctr['ip'], 'port': 80, 'timeout': 30}
+        db.mutate("INSERT INTO session_tunnels (uuid, rid, cbor) VALUES (?, ?, ?)",
+                  (tunnel['uuid'], rid, cbor.dumps(tunnel)))
+    db.flush()
+    model.descriptions_db.close()  # not Model.close, there should be no snapshot for the cold start
+    model.domains_db.close()
+    model.state_db.close()
+    return model.snapshot_filename
+
+
+def start(state, local):
+    begin = time.perf_counter()
+    model = Model(state, local)
+    elapsed = time.perf_counter() - begin
+    from_snapshot = not model.volumes_verified
+    sessions = len(model.sessions)
+    begin = time.perf_counter()
+    model.close()
+    return elapsed, time.perf_counter() - begin, from_snapshot, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sessions', type=int, default=10000)
+    parser.add_argument('--containers', type=int, default=2, help="per session")
+    parser.add_argument('--warm', type=int, default=3, help="number of warm starts")
+    parser.add_argument('--shared', action='store_true', help="local databases journalled to a 'shared' directory")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    Volume.all = staticmethod(lambda: {})
+
+    directory = tempfile.mkdtemp()
+    try:
+        state = os.path.join(directory, 'shared')
+        local = os.path.join(directory, 'local') if args.shared else None
+        os.makedirs(state)
+        snapshot = populate(state, local, args.sessions, args.containers)
+        print("%d sessions, %d containers, %s" % (args.sessions, args.sessions * args.containers,
+                                                 "journalled" if args.shared else "databases on the state directory"))
+
+        elapsed, closing, from_snapshot, loaded = start(state, local)
+        print("cold  %.3fs  (%d sessions, snapshot written in %.3fs: %d bytes)" %
+              (elapsed, loaded, closing, os.path.getsize(snapshot)))
+        for n in range(args.warm):
+            elapsed, closing, from_snapshot, loaded = start(state, local)
+            print("warm  %.3fs  (%d sessions, %s)" %
+                  (elapsed, loaded, "from the snapshot" if from_snapshot else "SNAPSHOT WAS STALE"))
+            if not from_snapshot:
+                sys.exit(1)
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
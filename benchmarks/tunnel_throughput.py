@@ -0,0 +1,184 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Throughput from a container back to the client through a tunnel, against reading a chunk per event"""
+
+# A local server (in its own process, standing in for the container) writes the given number of bytes as fast as it
+# can on each connection then closes it. A proxy is opened onto it through a real Tunnel, Reactor and Timers, and
+# the loop is run until the proxy closes. Compared are Tunnel.incoming and the path it replaced: one recv(8192)
+# per event and one from_proxy message per chunk. Each from_proxy costs send_cmd, which by default just counts it -
+# or with --agent goes through messidge's encryption process as it does in the broker (Broker.send_cmd).
+# Run from the repository root: python3 benchmarks/tunnel_throughput.py [--megabytes 256] [--connections 4]
+
+import os
+import sys
+import time
+import select
+import socket
+import argparse
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller.reactor import Reactor
+from controller.timers import Timers
+from controller.tunnel import Tunnel, ProxyReaper
+
+
+def source(listener, total):
+    chunk = b'\xa5' * (1024 * 1024)
+    while True:
+        connection, _ = listener.accept()
+        remaining = total
+        while remaining > 0:
+            remaining -= connection.send(memoryview(chunk)[:min(remaining, len(chunk))])
+        connection.close()
+
+
+class PerChunkTunnel(Tunnel):
+    """Tunnel.incoming as it was: a fixed size read per event, each sent as it was read"""
+    def incoming(self, proxy):
+        try:
+            bulk = proxy.socket.recv(8192)
+        except BlockingIOError:
+            return
+        except OSError:
+            bulk = b''
+        if len(bulk) == 0:
+            self._closed_by_container(proxy)
+            return
+        self.broker().reaper.touched(proxy)
+        self._to_client(b'from_proxy', proxy, bulk)
+
+
+class Message:
+    def __init__(self, remote_fd):
+        self.params = {'proxy': remote_fd}
+        self.bulk = b''
+
+    def reply(self, results=None):
+        raise RuntimeError("Proxy failed: " + str(results))
+
+
+class Client:
+    rid = b'\0\0\0\1'
+
+
+class Loop:
+    def __init__(self):
+        self.idle = set()
+
+    def register_on_idle(self, task):
+        self.idle.add(task)
+
+
+class Sink:
+    def send_multipart(self, parts):
+        pass
+
+
+class TunnelBroker:
+    """The parts of the broker a tunnel uses, counting what would be sent to the client"""
+    def __init__(self, encrypting):
+        self.loop = Loop()
+        self.reactor = Reactor()
+        self.timers = Timers()
+        self.timers.start(self.loop)
+        self.reaper = ProxyReaper(self.timers)
+        self.messages = 0
+        self.received = 0
+        self.closed = 0
+        self.agent = None
+        if encrypting:
+            from messidge.broker.agent import Agent
+            self.agent = Agent()
+            self.skt = Sink()
+            self.rid_session_key = {Client.rid: os.urandom(32)}
+            self.encrypting = 0
+
+    def stop(self):
+        self.reactor.stop()
+        if self.agent is not None:
+            self.agent.stop()
+            self.agent.join()
+
+    def send_cmd(self, rid, command, params, *, bulk=b'', uuid=b''):
+        if command == b'from_proxy':
+            self.messages += 1
+            self.received += len(bulk)
+        elif command == b'close_proxy':
+            self.closed += 1
+        if self.agent is not None:
+            from messidge.broker.broker import Broker as BrokerBase
+            from broker import Broker
+            Broker._make_room(self, rid, len(bulk))
+            BrokerBase.send_cmd(self, rid, command, params, bulk=bulk, uuid=uuid)
+
+    def _emit_all_encrypted(self, timeout=5):
+        from broker import Broker
+        return Broker._emit_all_encrypted(self, timeout)
+
+    def run_until_closed(self, count):
+        epoll = self.reactor.epoll.fileno()
+        fds = [epoll] if self.agent is None else [epoll, self.agent.encrypt_pipe[0].fileno()]
+        while self.closed < count:
+            ready, _, _ = select.select(fds, [], [], 0.5)
+            if epoll in ready:
+                self.reactor._events(epoll)
+            if len(fds) == 2 and self.agent.encrypt_pipe[0].poll():
+                self.agent.encrypt_pipe[0].recv()  # as _emit_encrypted, but there's no client to send it to
+            self.timers.run_due()
+        if self.agent is not None:
+            self._emit_all_encrypted()
+
+
+def run(tunnel_type, port, connections, encrypting):
+    broker = TunnelBroker(encrypting)
+    client = Client()  # the tunnel only keeps a weak reference
+    tunnel = tunnel_type(b'benchmark', client, broker, broker.loop, '127.0.0.1', port, 10)
+    start = time.perf_counter()
+    cpu = time.process_time()
+    for remote_fd in range(connections):
+        tunnel.forward(Message(remote_fd))
+    broker.run_until_closed(connections)
+    elapsed = time.perf_counter() - start, time.process_time() - cpu
+    broker.stop()
+    return elapsed + (broker, )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--megabytes', type=int, default=256, help="sent on each connection")
+    parser.add_argument('--connections', type=int, default=4, help="proxies open at once")
+    parser.add_argument('--agent', action='store_true', help="send each message through the encryption process")
+    args = parser.parse_args()
+
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(args.connections)
+    server = Process(target=source, args=(listener, args.megabytes * 1024 * 1024), daemon=True)
+    server.start()
+    try:
+        total = args.megabytes * args.connections
+        print("%d connection(s) of %dMB each%s" % (args.connections, args.megabytes,
+                                                   ", through the encryption process" if args.agent else ""))
+        for name, tunnel_type in (('incoming', Tunnel), ('per chunk', PerChunkTunnel)):
+            elapsed, cpu, broker = run(tunnel_type, listener.getsockname()[1], args.connections, args.agent)
+            if broker.received != total * 1024 * 1024:
+                raise RuntimeError("%s received %d bytes" % (name, broker.received))
+            print("%-10s %7.1fMB/s  %8d messages (%6.1fKB each)  %.2fs cpu" %
+                  (name, total / elapsed, broker.messages, broker.received / broker.messages / 1024, cpu))
+    finally:
+        server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -14,9 +14,16 @@
 # controller.network is symlinked over from noodle
 
 import os
+import logging
+import resource
+import cbor
+import libnacl
+import libnacl.utils
+from binascii import hexlify
 from subprocess import call
 from messidge.broker.broker import Broker as BrokerBase
 from messidge.broker.identity import Identity
+from messidge.broker.message import BrokerMessage
 from messidge import KeyPair
 from model.state import ClusterGlobalState
 from model.node import Node
@@ -26,14 +33,36 @@ from controller.controller import Controller
 from controller.images import Images
 from controller.inspect import LaksaInspection
 from controller.haproxy import HAProxy
+from controller.reactor import Reactor
+from controller.jobs import Jobs
+from controller.timers import Timers
+from controller.tunnel import ProxyReaper
 from controller.network import Network
+from controller.volumes import Volume
 
 
 class Broker(BrokerBase):
+    snapshot_interval = 600  # seconds between model snapshots (there is always one on a clean shutdown)
+    domain_shed_interval = 60  # seconds between looking for domain claims that have expired
+    marker_rid = b'marker'  # rids are four bytes, so never a session
+    marker_key = bytes(32)
+    encrypting_budget = 64 * 1024  # bytes sent to the encryption process before waiting for it to catch up
+    max_files = 65536  # soft limit on open files when the hard limit is unlimited (it's normally set by the unit)
+
     def __init__(self):
         # raise my priority
         os.setpriority(os.PRIO_PROCESS, 0, -15)
 
+        # each proxy is a file descriptor and the reaper allows half the soft limit (systemd defaults it to 1024)
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        wanted = hard if hard != resource.RLIM_INFINITY else Broker.max_files
+        if soft != resource.RLIM_INFINITY and soft < wanted:
+            try:
+                resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+                logging.info("Raised the open file limit from %d to %d" % (soft, wanted))
+            except (ValueError, OSError) as e:
+                logging.warning("Could not raise the open file limit from %d: %s" % (soft, str(e)))
+
         # HAProxy sometimes gets annoyed
         call(['systemctl', 'restart', 'haproxy'])
 
@@ -41,14 +70,24 @@ class Broker(BrokerBase):
         self.model = None
         self.env = None
         self.inspect = None
+        self.reactor = None
+        self.timers = None
+        self.reaper = None
+        self.jobs = None
+        self.encrypting = 0  # bytes (roughly) sent to the encryption process since it was last caught up with
 
         # get the base class up
         try:
             self.env = ClusterGlobalState()
             self.keys = KeyPair(public=self.env.pk, secret=self.env.sk)
-            self.model = Model(self.env.state_mountpoint)
+            self.model = Model(self.env.state_mountpoint,
+                               ClusterGlobalState.local_state_directory if self.env.efs is not None else None)
             self.network = Network()
-            self.images = Images()
+            self.jobs = Jobs()
+            self.images = Images(self.jobs)
+            self.reactor = Reactor()
+            self.timers = Timers()
+            self.reaper = ProxyReaper(self.timers)
             self.controller = Controller(self, self.model, self.network, self.images)
             super().__init__(self.keys, self.model, Node, Session, self.controller,
                              identity_type=LaksaIdentity,
@@ -60,7 +99,7 @@ class Broker(BrokerBase):
                              forwarding_insert_callback=self.model.set_forwarding_record,
                              forwarding_evict_callback=self.model.remove_forwarding_record
                              )
-            self.proxy = HAProxy(self.model)
+            self.proxy = HAProxy(self.model, self.jobs)
             self.inspect = LaksaInspection(self)
         except BaseException:
             self.stop()
@@ -74,14 +113,31 @@ class Broker(BrokerBase):
             Network.allow_incoming_from_node(node.subnet_id, reverse=True)
         Network.drop_incoming_from_underlay(reverse=True)
 
-        # stop objects that have background threads
+        # stop objects that have background threads (or sockets)
+        self.controller.resolver.stop()
+        self.reactor.stop()
+        self.jobs.stop()
         self.model.close()
         self.inspect.stop()
         self.env.stop()
 
     def pre_run(self):
-        # Register checking heartbeating from the controller
-        self.loop.register_on_idle(self.controller.check_heartbeat)
+        # Timers, DNS lookups, write readiness and background job completions are all driven from the loop
+        self.timers.start(self.loop)
+        self.controller.resolver.start(self.loop)
+        self.reactor.start(self.loop)
+        self.jobs.start(self.loop)
+        self.reaper.start()
+
+        # Check volumes from a model snapshot against zfs (which also re-shares them), and keep the snapshot fresh
+        if not self.model.volumes_verified:
+            self.jobs.submit(Volume.all, callback=self.model.verify_volumes, serial=Controller.verify_volumes_serial)
+        self.timers.call_later(Broker.snapshot_interval, self.snapshot_model)
+        self.timers.call_later(Broker.domain_shed_interval, self.shed_domains)
+
+        # Time out persisted sessions if they don't come back
+        for sess in self.model.sessions.values():
+            self.controller.watch_session(sess)
 
         # Any persisted tunnels need hooking into the broker and loop
         for tunnel in self.model.all_tunnels():
@@ -90,6 +146,106 @@ class Broker(BrokerBase):
         # Firewall against the underlay
         Network.drop_incoming_from_underlay()
 
+    def broadcast_cmd(self, command, params, *, nodes=False, user=None, exclude=None):
+        """Send the same command to many sessions, encoding the parameters only once.
+
+        :param command: a byte string of the command to send.
+        :param params: A {'key': 'value'} dictionary of parameters to send.
+        :param nodes: send to the nodes rather than the user sessions.
+        :param user: only send to the sessions belonging to this user (public key).
+        :param exclude: a rid to not send to, typically the one that caused the event.
+        """
+        # send_cmd passes each message through the encryption process, serialising it (and pickling it twice)
+        # every time. Here the parameters are serialised once and each session just gets its own secretbox, written
+        # straight to the socket - but only after everything already in the encryption process has been, so the
+        # broadcast can't overtake a message sent earlier to the same session. Nodes aren't encrypted, so there's
+        # nothing of theirs in the encryption process.
+        params = params if params is not None else {}
+        params_binary = None
+        plaintext = None
+        if nodes:
+            rids = list(self.node_rid_pk.keys())
+        elif user is None:
+            rids = list(self.model.sessions.keys())
+        else:
+            rids = self.model.sessions_for_user(user)
+        sent = 0
+        for rid in rids:
+            if rid == exclude:
+                continue
+            try:
+                session_key = self.rid_session_key[rid]
+            except KeyError:
+                logging.debug("Not broadcasting to rid with no session_key: " + hexlify(rid).decode())
+                continue
+
+            # session_key is None implies unencrypted
+            if session_key is None:
+                if plaintext is None:
+                    plaintext = cbor.dumps((b'', command, b'', params, b''))
+                self.skt.send_multipart((rid, plaintext))
+            else:
+                if params_binary is None:
+                    if not self._emit_all_encrypted():
+                        logging.error("Broadcast abandoned, the encryption process didn't come back: " +
+                                      command.decode())
+                        return sent
+                    params_binary = cbor.dumps(params)
+                nonce = libnacl.utils.rand_nonce()
+                encrypted = libnacl.crypto_secretbox(params_binary, nonce, session_key)
+                self.skt.send_multipart((rid, cbor.dumps((nonce, command, b'', encrypted, b''))))
+            sent += 1
+        return sent
+
+    def send_cmd(self, rid, command: bytes, params: dict, *, bulk: bytes=b'', uuid: bytes=b''):
+        self._make_room(rid, len(bulk))
+        super().send_cmd(rid, command, params, bulk=bulk, uuid=uuid)
+
+    def _make_room(self, rid, size):
+        # The encryption process hands each message back on the pipe it came in on, and won't read the next until it
+        # has - so if more than a pipe's buffer is sent before the loop gets round to emitting what came back, both
+        # ends wait for each other forever. A few large from_proxy messages will do it, so once more than the budget
+        # has gone in, we wait for it all to come back before sending any more.
+        if self.rid_session_key.get(rid) is None:
+            return  # unencrypted, or going to be dropped anyway
+        size += 512  # the parameters and framing, near enough
+        if self.encrypting != 0 and self.encrypting + size > Broker.encrypting_budget:
+            self._emit_all_encrypted()
+        self.encrypting += size
+
+    def _emit_all_encrypted(self, timeout=5):
+        # Sends a marker through the encryption process and emits everything that comes back before it. The process
+        # works through its pipe in order, so once the marker is back nothing sent before now is still in there.
+        pipe = self.agent.encrypt_pipe[0]
+        BrokerMessage.send_pipe(pipe, Broker.marker_rid, Broker.marker_key, b'', b'', b'', {})
+        while pipe.poll(timeout):
+            rid, session_key, parts = pipe.recv()
+            if rid == Broker.marker_rid:
+                self.encrypting = 0
+                return True
+            self.skt.send_multipart((rid, cbor.dumps(parts)))
+        return False  # will get to zmq on its own eventually, which drops it because there's no such peer
+
+    def _emit_encrypted(self, fd):
+        # _emit_all_encrypted may have emptied the pipe since the loop polled it, and the base class would block
+        if self.agent.encrypt_pipe[0].poll():
+            super()._emit_encrypted(fd)
+
+    def snapshot_model(self):
+        # gathered on the loop, written on a worker
+        self.jobs.submit(self.model.write_snapshot, self.model.snapshot(), serial='snapshot')
+        self.timers.call_later(Broker.snapshot_interval, self.snapshot_model)
+
+    def shed_domains(self):
+        self.model.shed_aged_domains()
+        self.timers.call_later(Broker.domain_shed_interval, self.shed_domains)
+
+    def _create_user_session(self, msg, skt, config):
+        # the base class has no callback for a new session, and we need to watch it for heartbeats
+        session_key = super()._create_user_session(msg, skt, config)
+        self.controller.watch_session(self.model.sessions[msg.rid])
+        return session_key
+
     def session_recovered(self, session, old_rid, new_rid):
         # ensure the backlink from containers is correct
         for uuid in session.dependent_containers.keys():
@@ -105,19 +261,21 @@ class Broker(BrokerBase):
         self.model.delete_session_record(rid)
 
     def node_created(self, pk):
+        self.model.offers.changed('nodes')
+
         # let the clients know
-        for rid in list(self.model.sessions.keys()):
-            self.send_cmd(rid, b'node_created', {'node': pk})
+        self.broadcast_cmd(b'node_created', {'node': pk})
         # topology is recreated when the node sends its' external IP
 
     def node_destroyed(self, pk):
+        self.controller.stats.forget(pk)
+        self.model.offers.changed('nodes')
+
         # let the clients know
-        for rid in list(self.model.sessions.keys()):
-            self.send_cmd(rid, b'node_destroyed', {'node': pk})
+        self.broadcast_cmd(b'node_destroyed', {'node': pk})
 
-        # let the individual containers know
-        for ctr in self.model.containers.values():
-            self.controller._impl_destroyed_container(ctr.uuid, ctr.ip)
+        # the containers on that node have gone with it
+        self.controller._impl_destroyed_node(pk)
 
         # advertise new topology
         self.node_topology()
@@ -130,8 +288,7 @@ class Broker(BrokerBase):
             Network.allow_incoming_from_node(sn)
         for sn in remove_subnets:
             Network.allow_incoming_from_node(sn, reverse=True)
-        for this_rid in self.node_rid_pk.keys():
-            self.send_cmd(this_rid, b'network_topology', {"topology": topology})
+        self.broadcast_cmd(b'network_topology', {"topology": topology}, nodes=True)
 
 
 class LaksaIdentity(Identity):
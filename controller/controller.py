@@ -13,42 +13,69 @@
 """Commands issued to the master"""
 
 # The broker is single threaded so these must all be non-blocking  ... ish
+# anything that blocks for real (subprocesses, decompression) goes onto broker.jobs and replies from the callback
 # the presence of msg.params is checked by check_basic_properties
 
 import logging
 import time
-import threading
-import socket
-from sqlite3 import IntegrityError
 from base64 import b64encode
 from binascii import hexlify
-from DNS.lazy import dnslookup
-from DNS.Base import ServerError
 from messidge.broker.broker import BrokerMessage
 from controller.tunnel import Tunnel
+from controller.jobs import Jobs
 from controller.volumes import Volume
+from controller.metrics import CommandMetrics
+from controller.resolver import Resolver
+from controller.tcpwait import TcpWaiter
+from controller.stats import StatsAggregator
 from model.container import Container
 from model.domain import Domain
 from model.cluster import Cluster
 
 
 class Controller:
+    session_timeout = 120  # seconds without a heartbeat
+    container_lease = 180  # seconds a node keeps a container alive without hearing from us (lease_containers)
+    verify_volumes_serial = 'verify-volumes'  # series for checking volumes against zfs, see _volume_serial
+
     def __init__(self, broker, model, network, images):
         self.broker = broker
         self.model = model
         self.network = network
         self.images = images
         self.last_heartbeat = time.time()
-
-    def check_heartbeat(self):
-        # is it that time?
-        tme = time.time()
-        # check to ensure the sessions are live
-        for rid, sess in list(self.model.sessions.items()):
-            if tme - sess.last_heartbeat >= 120:
-                logging.info("Session timed out: " + hexlify(sess.rid).decode())
-                sess.close(self.broker)
-                self.broker.disconnect_for_rid(sess.rid)
+        self.resolver = Resolver(broker.timers)
+        self.tcp_waiter = TcpWaiter(broker.reactor, broker.timers)
+        self.stats = StatsAggregator(broker, model, broker.timers)
+        self.creating_volumes = set()  # (user, tag) for volumes that are being created but not in the model yet
+        self.destroying_volumes = {}  # uuid -> volume, out of the model while zfs destroys it (back in if it can't)
+
+        # instrument the command handlers (the broker calls them with getattr so instance attributes win)
+        self.metrics = CommandMetrics()
+        for command in Controller.commands.keys():
+            name = '_' + command.decode()
+            setattr(self, name, self.metrics.instrument(command.decode(), getattr(self, name), self._origin))
+
+    def _origin(self, msg):
+        return 'node' if msg.rid in self.broker.node_rid_pk else 'client'
+
+    def watch_session(self, sess):
+        """Start (if need be) the timer that times the session out when heartbeats stop"""
+        if sess.expiry_timer is None:
+            sess.expiry_timer = self.broker.timers.call_at(sess.last_heartbeat + Controller.session_timeout,
+                                                           self._check_session, sess)
+
+    def _check_session(self, sess):
+        # heartbeats only update last_heartbeat so the timer gets pushed back when it fires, not on every heartbeat
+        sess.expiry_timer = None
+        if self.model.sessions.get(sess.rid) is not sess:
+            return  # already gone
+        if time.time() - sess.last_heartbeat < Controller.session_timeout:
+            self.watch_session(sess)
+            return
+        logging.info("Session timed out: " + hexlify(sess.rid).decode())
+        sess.close(self.broker)
+        self.broker.disconnect_for_rid(sess.rid)
 
     def _update_stats(self, msg):
         """Receiving updated performance counters from a node"""
@@ -66,45 +93,22 @@ class Controller:
             logging.warning("model.nodes is None for: " + b64encode(pk).decode())
             return
 
-        # update
-        old_stats = node.perf_counters
+        # update the model, the aggregator decides whether anyone else needs to know
         try:
             node.update_stats(msg.params['stats'])
         except KeyError:
             logging.warning("Node sent broken stats: " + str(msg.params['stats']))
-
-        # did it change?
-        if old_stats == node.perf_counters:
             return
-
-        # update server weights
-        self.broker.proxy.rebuild()
-
-        # distribute to the sessions
-        for rid in list(self.model.sessions.keys()):
-            self.broker.send_cmd(rid, b'update_stats', {'node': pk, 'stats': msg.params['stats']})
+        self.stats.updated(pk)
 
     def _wait_tcp(self, msg):
         """Returns the message when L4 is up on a particular container and port,
-        a blocking operation so spawns a thread"""
-        def _impl_wait_tcp(c, m):
-            attempts = 0
-            while True:
-                time.sleep(0.5)
-                try:
-                    s = socket.create_connection((c.ip, m.params['port']))
-                    m.reply()
-                    return
-                except (ConnectionRefusedError, OSError, TimeoutError):
-                    attempts += 1
-                    if attempts == 60:
-                        m.reply({'exception': 'Could not connect'})
-                        return
-
+        or optionally when a GET for msg.params['http'] returns 2xx/3xx"""
         ctr = self._ensure_valid_container(msg.rid, msg.params['container'])
-        t = threading.Thread(target=_impl_wait_tcp, args=(ctr, msg),
-                             name="Waiting for TCP on: " + msg.params['container'].decode())
-        t.start()
+        self.tcp_waiter.wait(msg, ctr.ip, msg.params['port'],
+                             timeout=msg.params['timeout'] if 'timeout' in msg.params else 30,
+                             backoff=msg.params['backoff'] if 'backoff' in msg.params else None,
+                             http=msg.params['http'] if 'http' in msg.params else None)
 
     def _inform_external_ip(self, msg):
         """Receiving a node's external IP, send topology to all nodes"""
@@ -116,6 +120,10 @@ class Controller:
         if 'instance_id' in msg.params:
             self.model.nodes[pk].instance_id = msg.params['instance_id']
 
+        # newer nodes tell us which optional messages they understand
+        if 'features' in msg.params:
+            self.model.nodes[pk].features = set(msg.params['features'])
+
     def _upload_requirements(self, msg):
         """Given a list of layers, return a list of the ones that need uploading"""
         to_be_uploaded = self.broker.images.upload_requirements(msg.params['layers'])
@@ -123,15 +131,21 @@ class Controller:
 
     def _upload_slab(self, msg):
         """Delivering a piece of layer"""
-        log_msg = self.broker.images.upload_slab(msg.params['sha256'], msg.params['slab'], msg.bulk)
-        msg.reply({'log': log_msg})
+        bulk = msg.bulk
+        msg.bulk = b''  # don't hold on to the slab (or echo it back in the reply)
+        self.broker.images.upload_slab(msg.params['sha256'], msg.params['slab'], bulk,
+                                       lambda log_msg, e: Jobs.reply(msg, {'log': log_msg}, e))
 
     def _upload_complete(self, msg):
         """The layer upload is complete"""
-        log_msg = self.broker.images.upload_complete(msg.params['sha256'])
-        logging.info(log_msg)
         msg.bulk = b''
-        msg.reply({'log': log_msg})
+        self.broker.images.upload_complete(msg.params['sha256'],
+                                           lambda log_msg, e: self._upload_completed(msg, log_msg, e))
+
+    def _upload_completed(self, msg, log_msg, exception):
+        if exception is None:
+            logging.info(log_msg)
+        Jobs.reply(msg, {'log': log_msg}, exception)
 
     def _allocate_ip(self, msg):
         """Called by a node - allocate an ip address in the right subnet"""
@@ -155,7 +169,7 @@ class Controller:
         tunnel = Tunnel(msg.uuid, sess, self.broker, self.broker.loop,
                         ctr.ip, msg.params['port'], msg.params['timeout'])
         sess.tunnels[msg.uuid] = tunnel
-        self.model.update_session_record(sess)
+        self.model.set_tunnel_record(sess, tunnel)
 
     def _destroy_tunnel(self, msg):
         """Destroy a tunnel onto a container"""
@@ -164,7 +178,7 @@ class Controller:
             tun = sess.tunnels[msg.params['tunnel']]
             tun.disconnect()
             del sess.tunnels[tun.uuid]
-            self.model.update_session_record(sess)
+            self.model.delete_tunnel_record(tun.uuid)
             logging.info("Destroyed tunnel uuid: " + tun.uuid.decode())
         except KeyError:
             raise ValueError("Unknown session or tunnel")
@@ -177,6 +191,14 @@ class Controller:
         except KeyError:
             pass
 
+    def _grant_proxy(self, msg):
+        """Flow control - the client can take this many more bytes from the proxy"""
+        try:
+            sess = self._ensure_valid_session(msg.rid)
+            sess.tunnels[msg.params['tunnel']].grant(msg.params['proxy'], msg.params['bytes'])
+        except KeyError:
+            pass
+
     def _close_proxy(self, msg):
         """Done with the tunnel"""
         try:
@@ -186,19 +208,30 @@ class Controller:
             # sometimes we close this end, which closes the other end and sends a message telling this end to close
             pass
 
+    def _resources_since(self, msg):
+        # for a client that is reconnecting, and has the version from the last offer it saw
+        msg.reply(self.model.resources_since(msg.params['user'], msg.params['version']))
+
     def _cache_description(self, msg):
+        # digest is optional: the one we gave out with the description, or sha256 of its cbor encoding
         self.model.create_update_description_record(msg.params['user'],
                                                     msg.params['image_id'],
-                                                    msg.params['description'])
+                                                    msg.params['description'],
+                                                    msg.params.get('digest'))
         logging.debug("Cached description for: " + msg.params['image_id'])
 
     def _retrieve_description(self, msg):
         full_id = b64encode(msg.params['user']).decode() + msg.params['image_id']
-        if full_id in self.model.descriptions:
-            logging.debug("Cache hit on descriptions for: " + msg.params['image_id'])
-            msg.reply(results={'description': self.model.descriptions[full_id]})
+        if self.model.descriptions.unchanged(full_id, msg.params.get('digest')):
+            logging.debug("Description not modified for: " + msg.params['image_id'])
+            msg.reply(results={'not_modified': True})
+            return
+        description = self.model.descriptions.get(full_id)  # reads the database on a miss
+        if description is not None:
+            logging.debug("Found description for: " + msg.params['image_id'])
+            msg.reply(results={'description': description, 'digest': self.model.descriptions.digest(full_id)})
         else:
-            logging.debug("Cache miss on descriptions for: " + msg.params['image_id'])
+            logging.debug("No description for: " + msg.params['image_id'])
             msg.reply()
 
     def _dependent_container(self, msg):
@@ -207,6 +240,7 @@ class Controller:
                                             msg.params['container'],
                                             msg.params['cookie']['tag']):
             logging.info("Tried to register a dependent container but there would be a namespace collision.")
+            self.model.release_ip(msg.params['ip'])
             self.broker.send_cmd(msg.rid, b'destroy_container', {'container': msg.params['container'],
                                                                  'inform': False})
             return
@@ -222,14 +256,15 @@ class Controller:
                             msg.params['volumes'])
             sess = self.model.sessions[msg.params['cookie']['session']]
             sess.dependent_containers[ctr.uuid] = ctr
-            self.model.containers.add(ctr)  # this is the tagged collection
-            self.model.update_session_record(sess)
+            self.model.add_container(ctr)
+            self.model.set_container_record(sess, ctr)
             logging.info("Registered a dependency: %s -> %s" %
                          (hexlify(msg.params['cookie']['session']).decode(),
                           msg.params['container'].decode()))
         except KeyError:
             # if trying to register but the session has disappeared already, tell the node to destroy the container
             logging.info("Tried to register a dependent container to a session that has already gone, destroying.")
+            self.model.release_ip(msg.params['ip'])
             self.broker.send_cmd(msg.rid, b'destroy_container', {'container': msg.params['container'],
                                                                  'inform': False})  # don't inform because session gone
             return
@@ -246,58 +281,103 @@ class Controller:
         # try to find (and delete) the container
         try:
             ctr = self.model.containers[uuid]
-            self.model.containers.remove(ctr)
         except KeyError:
             logging.debug("Informed of destroyed container but couldn't find: " + uuid.decode())
             return
-
-        # can we associate it with a session?
+        self._forget_container(ctr)
+        self.model.delete_container_records([uuid])
+
+    def _impl_destroyed_node(self, pk):
+        # the node has gone and taken its containers with it - deleted from storage with a single statement
+        containers = self.model.containers_on_node(pk)
+        affected = set()
+        for ctr in containers:
+            self.model.release_ip(ctr.ip)
+            sess = self._forget_container(ctr)
+            if sess is not None:
+                affected.add(sess.rid)
+        self.model.delete_container_records(ctr.uuid for ctr in containers)
+        logging.info("Node loss affected %d session(s)" % len(affected))
+
+    def _forget_container(self, ctr):
+        # removes from the model, returns the session it belonged to (if it can be found)
+        self.model.remove_container(ctr)
         try:
             sess = self.model.sessions[ctr.session_rid]
-            del sess.dependent_containers[uuid]
-            self.model.update_session_record(sess)
+            del sess.dependent_containers[ctr.uuid]
+            return sess
         except KeyError:
-            logging.debug("Session or dependency has disappeared before destroying: ctr-" + uuid.decode())
+            logging.debug("Session or dependency has disappeared before destroying: ctr-" + ctr.uuid.decode())
+            return None
 
     def _create_volume(self, msg):
         """Create a local zfs volume to be shared with containers"""
-        if self.model.volumes.will_clash(msg.params['user'], msg.uuid, msg.params['tag']):
+        user = msg.params['user']
+        tag = msg.params['tag']
+        destroying = {(vol.user, vol.tag) for vol in self.destroying_volumes.values() if vol.tag is not None}
+        if self.model.volumes.will_clash(user, msg.uuid, tag) or (user, tag) in self.creating_volumes | destroying:
             raise ValueError("Volume tag is already being used")
-        vol = Volume.create(msg.params['user'], msg.uuid, msg.params['tag'], msg.params['async'])
-        self.model.volumes.add(vol)
+        if tag is not None:
+            self.creating_volumes.add((user, tag))
+        self.broker.jobs.submit(Volume.create, user, msg.uuid, tag, msg.params['async'],
+                                callback=lambda vol, e: self._volume_created(msg, vol, e),
+                                serial=self._volume_serial(msg.uuid))
+
+    def _volume_created(self, msg, vol, exception):
+        self.creating_volumes.discard((msg.params['user'], msg.params['tag']))
+        if exception is not None:
+            Jobs.reply(msg, None, exception)
+            return
+        self.model.add_volume(vol)
         msg.reply()
 
-        # let the clients know
-        for rid in list(self.model.sessions.keys()):
-            if rid != msg.rid:
-                self.broker.send_cmd(rid, b'volume_created', {'volume': msg.uuid, 'tag': msg.params['tag']})
+        # let the user's other sessions know
+        self.broker.broadcast_cmd(b'volume_created', {'volume': msg.uuid, 'tag': msg.params['tag']},
+                                  user=msg.params['user'], exclude=msg.rid)
 
     def _destroy_volume(self, msg):
         # is it mounted in any containers?
-        for sess in self.model.sessions.values():
-            for ctr in sess.dependent_containers.values():
-                if msg.params['volume'] in ctr.volumes:
-                    raise ValueError("Volume is mounted in a container: " + ctr.uuid.decode())
+        mounted = self.model.containers_mounting(msg.params['volume'])
+        if len(mounted) != 0:
+            raise ValueError("Volume is mounted in a container: " + mounted[0].uuid.decode())
 
-        # destroy
+        # destroy - out of the model now so nothing else can find it while zfs is busy
         vol = self._ensure_valid_volume(msg)
-        vol.destroy()
-        self.model.volumes.remove(vol)
-        msg.reply()
+        self.model.remove_volume(vol)
+        self.destroying_volumes[vol.uuid] = vol
+        self.broker.jobs.submit(vol.destroy,
+                                callback=lambda _, e: self._volume_destroyed(msg, vol, e),
+                                serial=self._volume_serial(vol.uuid))
+
+    def _volume_destroyed(self, msg, vol, exception):
+        del self.destroying_volumes[vol.uuid]
+        Jobs.reply(msg, None, exception)
+        if exception is not None:
+            # still there as far as zfs is concerned, so the user needs to be able to see it and try again
+            logging.warning("Failed destroying volume, putting it back in the model: " + vol.uuid.decode())
+            self.model.add_volume(vol)
+            return
 
-        # let the clients know
-        for rid in list(self.model.sessions.keys()):
-            if rid != msg.rid:
-                self.broker.send_cmd(rid, b'volume_destroyed', {'volume': msg.params['volume']})
+        # let the user's other sessions know
+        self.broker.broadcast_cmd(b'volume_destroyed', {'volume': msg.params['volume']},
+                                  user=msg.params['user'], exclude=msg.rid)
 
     def _snapshot_volume(self, msg):
-        self._ensure_valid_volume(msg).snapshot()
+        vol = self._ensure_valid_volume(msg)
+        self.broker.jobs.submit(vol.snapshot, serial=self._volume_serial(vol.uuid))
 
     def _rollback_volume(self, msg):
-        self._ensure_valid_volume(msg).rollback()
+        vol = self._ensure_valid_volume(msg)
+        self.broker.jobs.submit(vol.rollback, serial=self._volume_serial(vol.uuid))
+
+    def _volume_serial(self, uuid):
+        # zfs jobs on a volume run one at a time, and all of them queue behind checking a snapshot's volumes against
+        # zfs (until the jobs that queued there have gone) - so the check doesn't see half of a create or destroy
+        if self.model.volumes_verified and not self.broker.jobs.in_series(Controller.verify_volumes_serial):
+            return 'volume', uuid
+        return Controller.verify_volumes_serial
 
     def _prepare_domain(self, msg):
-        # shedding aged domains will have happened already as part of the resource offer, dict entry will exist
         domain = msg.params['domain']
         if domain is None:
             raise ValueError("Need a domain name")
@@ -312,27 +392,15 @@ class Controller:
         except KeyError:
             pass
 
-        # try to create a new domain, see if the db borks
+        # try to create a new domain, raises if someone else has it
         obj = Domain(domain, msg.uuid, sess.pk)
-        try:
-            self.model.create_domain_record(obj, sess)  # may throw so domain won't be added to dict
-            self.model.domains[sess.pk][domain] = obj
-        except IntegrityError:
-            logging.debug("Trying to prepare domain, shedding aged domains: " + msg.params['domain'])
-            self.model.shed_aged_domains()  # and try again
-            try:
-                self.model.create_domain_record(obj, sess)
-                self.model.domains[sess.pk].add(obj)
-                logging.debug("Managed to prepare domain.")
-            except IntegrityError:
-                logging.debug("Shedding aged domains failed to free.")
-                raise ValueError('This domain is already claimed or in the process of being claimed')
+        self.model.add_domain(obj)
+        self.model.create_domain_record(obj, sess)
 
         logging.info("User (%s) prepared to claim domain: %s" % (b64encode(sess.pk).decode(), domain))
         msg.reply({'token': obj.token})
 
     def _claim_domain(self, msg):
-        # TODO: A blocking DNS call right in the middle of the message loop is a terrible idea.
         domain = msg.params['domain']
         if domain is None:
             raise ValueError("Need a domain name")
@@ -344,19 +412,31 @@ class Controller:
         if dom.is_valid():
             raise ValueError("Domain has already been claimed")
 
-        # look it up, then
+        # look it up, then - the reply happens when the answer arrives
         token_url = 'tf-token.' + domain
+        self.resolver.txt(token_url, lambda records, error: self._claim_domain_answer(msg, sess, dom, token_url,
+                                                                                      records, error))
+
+    def _claim_domain_answer(self, msg, sess, dom, token_url, token_from_dns, error):
+        # called from the resolver, so exceptions need to be passed back by hand
         try:
-            token_from_dns = dnslookup(token_url, 'txt')
-        except ServerError:
-            raise ValueError("Did not find a TXT record for " + token_url)
-        if len(token_from_dns) != 1 or len(token_from_dns[0]) != 1:
-            raise ValueError("DNS token was malformed (more than one txt record?)")
-        if token_from_dns[0][0] != dom.token:
-            raise ValueError("DNS returned the wrong token, needed " + dom.token.decode())
+            if error is not None:
+                logging.debug("TXT lookup failed for %s: %s" % (token_url, error))
+                raise ValueError("Did not find a TXT record for " + token_url)
+            if len(token_from_dns) != 1 or len(token_from_dns[0]) != 1:
+                raise ValueError("DNS token was malformed (more than one txt record?)")
+            if token_from_dns[0][0] != dom.token:
+                raise ValueError("DNS returned the wrong token, needed " + dom.token.decode())
+            if self.model.domains.get(sess.pk, {}).get(dom.domain) is not dom:
+                raise ValueError("Domain was released while being claimed")
+        except ValueError as e:
+            logging.info("Client %s called claim_domain and raised a ValueError: %s" %
+                         (hexlify(msg.rid).decode(), str(e)))
+            msg.reply({'exception': str(e)})
+            return
         dom.mark_as_valid()
         self.model.update_domain_record(dom)
-        logging.info("User (%s) successfully claimed domain: %s" % (b64encode(sess.pk).decode(), domain))
+        logging.info("User (%s) successfully claimed domain: %s" % (b64encode(sess.pk).decode(), dom.domain))
         msg.reply()
 
     def _make_domain_global(self, msg):
@@ -381,7 +461,7 @@ class Controller:
             raise ValueError("Need a domain name")
         sess = self._ensure_valid_session(msg.rid)
         try:
-            del self.model.domains[sess.pk][domain]
+            self.model.remove_domain(self.model.domains[sess.pk][domain])
             self.model.delete_domain_record(domain)
         except KeyError:
             raise ValueError("Domain has not been either prepared or claimed by you")
@@ -391,7 +471,7 @@ class Controller:
     def _publish_web(self, msg):
         # does this user own this domain?
         sess = self._ensure_valid_session(msg.rid)
-        domains = self.model.global_domains
+        domains = dict(self.model.global_domains)  # a copy, the user's own are added to it
         try:
             for d in self.model.domains[sess.pk].values():
                 domains[d.domain] = d
@@ -408,9 +488,8 @@ class Controller:
 
         # is someone else using this fqdn already?
         fqdn = msg.params['subdomain'] + msg.params['domain']
-        for cluster in self.model.all_clusters():
-            if cluster.fqdn() == fqdn:
-                raise ValueError("FQDN is being used by another session")
+        if self.model.cluster_for_fqdn(fqdn) is not None:
+            raise ValueError("FQDN is being used by another session")
 
         # are the container uuids correct
         try:
@@ -423,7 +502,8 @@ class Controller:
                           msg.params['domain'], msg.params['subdomain'], msg.params['ssl'], msg.params['rewrite'],
                           containers)
         sess.clusters[msg.uuid] = cluster
-        self.model.update_session_record(sess)
+        self.model.add_cluster(cluster)
+        self.model.set_cluster_record(sess, cluster)
         self.broker.proxy.rebuild()
         logging.info("Published cluster (%s) to: %s" % (msg.uuid.decode(), fqdn))
         msg.reply()
@@ -431,11 +511,12 @@ class Controller:
     def _unpublish_web(self, msg):
         # correct user?
         sess = self._ensure_valid_session(msg.rid)
-        self._ensure_valid_cluster(sess, msg.params['cluster'])
+        cluster = self._ensure_valid_cluster(sess, msg.params['cluster'])
 
         # all good
         del sess.clusters[msg.params['cluster']]
-        self.model.update_session_record(sess)
+        self.model.remove_cluster(cluster)
+        self.model.delete_cluster_record(cluster.uuid)
         self.broker.proxy.rebuild()
         logging.info("Unpublished cluster: " + msg.params['cluster'].decode())
 
@@ -445,7 +526,7 @@ class Controller:
         ctr = self._ensure_valid_container(msg.rid, msg.params['container'])
         if ctr.uuid not in clstr.containers:
             clstr.containers[ctr.uuid] = ctr
-            self.model.update_session_record(sess)
+            self.model.set_cluster_record(sess, clstr)
             self.broker.proxy.rebuild()
             logging.info("Added (%s) to cluster: %s" % (msg.params['container'].decode(),
                                                         msg.params['cluster'].decode()))
@@ -457,7 +538,7 @@ class Controller:
         ctr = self._ensure_valid_container(msg.rid, msg.params['container'])
         if ctr.uuid in clstr.containers:
             del clstr.containers[ctr.uuid]
-            self.model.update_session_record(sess)
+            self.model.set_cluster_record(sess, clstr)
             self.broker.proxy.rebuild()
             logging.info("Removed (%s) form cluster: %s" % (msg.params['container'].decode(),
                                                             msg.params['cluster'].decode()))
@@ -472,17 +553,31 @@ class Controller:
                             hexlify(msg.rid).decode())
             return
         sess.last_heartbeat = time.time()
+        self.watch_session(sess)
 
-        # heartbeat the containers in the session
+        # renew the containers in the session, one message per node if the node understands it
+        by_node = {}
         for uuid, ctr in sess.dependent_containers.items():
+            by_node.setdefault(ctr.node_pk, []).append(uuid)
+        for node_pk, uuids in by_node.items():
             try:
-                node_rid = self.broker.node_pk_rid[ctr.node_pk]
-                BrokerMessage.send_socket(self.broker.skt, node_rid, b'',
-                                          b'heartbeat_container', b'', {'container': uuid})
+                node_rid = self.broker.node_pk_rid[node_pk]
+                features = self.model.nodes[node_pk].features
             except KeyError:
                 # node is temporarily (hopefully) offline
                 logging.warning("Tried to heartbeat a container but couldn't find the node: "
-                                + b64encode(ctr.node_pk).decode())
+                                + b64encode(node_pk).decode())
+                continue
+            if 'lease_containers' in features:
+                BrokerMessage.send_socket(self.broker.skt, node_rid, b'', b'lease_containers', b'',
+                                          {'containers': uuids, 'lease': Controller.container_lease})
+            elif 'heartbeat_containers' in features:
+                BrokerMessage.send_socket(self.broker.skt, node_rid, b'', b'heartbeat_containers', b'',
+                                          {'containers': uuids})
+            else:  # older node
+                for uuid in uuids:
+                    BrokerMessage.send_socket(self.broker.skt, node_rid, b'',
+                                              b'heartbeat_container', b'', {'container': uuid})
 
     def _ping(self, msg):
         msg.reply()
@@ -530,6 +625,7 @@ class Controller:
 
     # commands are: {b'command': (['list', 'essential, 'params'], needs_reply, node_only),....}
     # update_volumes and upload_requirements get passed a list, hence no check for parameters
+    # optional parameters aren't listed: 'digest' for cache_description and retrieve_description
     commands = {b'inform_external_ip': (['ip'], False, True),
                 b'update_stats': (['stats'], False, True),
 
@@ -538,6 +634,9 @@ class Controller:
                 b'destroy_tunnel': (['tunnel'], False, False),
                 b'to_proxy': (['tunnel', 'proxy'], False, False),
                 b'close_proxy': (['tunnel', 'proxy'], False, False),
+                b'grant_proxy': (['tunnel', 'proxy', 'bytes'], False, False),
+
+                b'resources_since': (['version'], True, False),
 
                 b'cache_description': (['image_id', 'description'], False, False),
                 b'retrieve_description': (['image_id'], True, False),
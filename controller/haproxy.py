@@ -19,8 +19,10 @@ from subprocess import call, DEVNULL
 
 
 class HAProxy:
-    def __init__(self, model):
+    def __init__(self, model, jobs):
         self.model = weakref.ref(model)
+        self.jobs = jobs
+        self.reload_queued = False
         # Ensure file structure
         self.rebuild()
 
@@ -78,8 +80,15 @@ class HAProxy:
 
         with open('haproxy.cfg') as f:
             after = f.read()
-        if before != after:
-            call(['systemctl', 'reload', 'haproxy'], stdout=DEVNULL)
+        if before != after and not self.reload_queued:
+            # a reload that hasn't started yet will pick this change up too
+            self.reload_queued = True
+            self.jobs.submit(self._reload, serial='haproxy')
+
+    def _reload(self):
+        # on a worker thread, any change from here on needs another reload
+        self.reload_queued = False
+        call(['systemctl', 'reload', 'haproxy'], stdout=DEVNULL)
 
     @staticmethod
     def _aclname(cluster):
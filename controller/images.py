@@ -18,7 +18,9 @@ import lzma
 
 
 class Images:
-    def __init__(self):
+    def __init__(self, jobs):
+        self.jobs = jobs
+
         # ensure the cache directory exists
         os.makedirs("state/layer_cache", exist_ok=True)
 
@@ -54,24 +56,45 @@ class Images:
             rtn_layers.add(layer)
         return list(rtn_layers)
 
-    def upload_slab(self, sha256, slab, bulk):
+    def upload_slab(self, sha256, slab, bulk, callback):
+        """Decompress and write a slab, callback(log_msg, exception) happens from the loop"""
         # open files on demand
         try:
             if sha256 not in self.is_being_uploaded:
                 self.is_being_uploaded[sha256] = open('state/layer_cache/' + sha256 + '.uploading', "w+b")
         except BaseException as e:
             raise ValueError(e)
-        self.is_being_uploaded[sha256].write(lzma.decompress(bulk))
-        return "Location received slab: %s" % str(slab + 1)[:16]
 
-    def upload_complete(self, sha256):
+        # slabs (and completion) for one layer are serialised so they get written in order
+        self.jobs.submit(Images._write_slab, self.is_being_uploaded[sha256], slab, bulk,
+                         callback=callback, serial=('layer', sha256))
+
+    def upload_complete(self, sha256, callback):
         """Place a delivered layer into the database."""
         # is this a layer we're expecting to see?
-        self.is_being_uploaded[sha256].close()
+        if sha256 not in self.is_being_uploaded:
+            raise ValueError("Not expecting a layer: " + sha256[:16])
+        self.jobs.submit(Images._place_layer, self.is_being_uploaded[sha256], sha256,
+                         callback=lambda log_msg, exception: self._placed(sha256, log_msg, exception, callback),
+                         serial=('layer', sha256))
+
+    def _placed(self, sha256, log_msg, exception, callback):
+        if exception is None:
+            self.cached_layers.add(sha256)
+            self.is_being_uploaded.pop(sha256, None)
+        callback(log_msg, exception)
+
+    @staticmethod
+    def _write_slab(f, slab, bulk):
+        # on a worker thread, lzma releases the GIL while it decompresses
+        f.write(lzma.decompress(bulk))
+        return "Location received slab: %s" % str(slab + 1)[:16]
+
+    @staticmethod
+    def _place_layer(f, sha256):
+        # on a worker thread
+        f.close()
         os.rename('state/layer_cache/' + sha256 + '.uploading', 'state/layer_cache/' + sha256)
-        # all good
-        self.cached_layers.add(sha256)
-        del self.is_being_uploaded[sha256]
         return "Location received complete layer: " + sha256[:16]
 
     def __repr__(self):
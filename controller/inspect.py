@@ -74,6 +74,36 @@ class LaksaInspection(InspectionServer):
             'tagged_containers': [ctr.global_display_name() for ctr in bkr.model.containers.values()
                                   if ctr.tag is not None],
             'domains': {d.domain: d.state() for d in domains},
-            'allocations': list(bkr.model.allocations)
+            'allocations': bkr.model.allocations.counts()  # fuller statistics on /allocations
         }
         return json.dumps(rtn, indent=2) + "\n"
+
+    @staticmethod
+    @inspection_server.route('/commands')
+    def commands():
+        bkr = InspectionServer.parent()
+        return json.dumps(bkr.controller.metrics.state(), indent=2, sort_keys=True) + "\n"
+
+    @staticmethod
+    @inspection_server.route('/descriptions')
+    def descriptions():
+        bkr = InspectionServer.parent()
+        return json.dumps(bkr.model.descriptions.state(), indent=2, sort_keys=True) + "\n"
+
+    @staticmethod
+    @inspection_server.route('/allocations')
+    def allocations():
+        bkr = InspectionServer.parent()
+        return json.dumps(bkr.model.allocations.state(), indent=2, sort_keys=True) + "\n"
+
+    @staticmethod
+    @inspection_server.route('/offers')
+    def offers():
+        bkr = InspectionServer.parent()
+        return json.dumps(bkr.model.offers.state(), indent=2, sort_keys=True) + "\n"
+
+    @staticmethod
+    @inspection_server.route('/proxies')
+    def proxies():
+        bkr = InspectionServer.parent()
+        return json.dumps(bkr.reaper.state(), indent=2, sort_keys=True) + "\n"
@@ -0,0 +1,131 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Runs blocking work (subprocesses, decompression) away from the message loop"""
+
+# Jobs run on a thread pool, or a process pool if one was asked for and the job wants it (process jobs need to be
+# picklable, so module level functions with plain arguments). When a job finishes the worker posts it to a
+# completion queue and writes a byte down a pipe that the loop is watching, so callbacks happen on the loop and
+# can touch the model and reply to messages as normal.
+# callbacks have the signature callback(result, exception) where exception is None unless the job raised.
+# Jobs submitted with the same 'serial' key run one after the other in the order they were submitted.
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+class Job:
+    __slots__ = ('fn', 'args', 'callback', 'serial', 'process')
+
+    def __init__(self, fn, args, callback, serial, process):
+        self.fn = fn
+        self.args = args
+        self.callback = callback
+        self.serial = serial
+        self.process = process
+
+
+class Jobs:
+    def __init__(self, *, threads=4, processes=0):
+        self.thread_pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='job')
+        self.process_pool = ProcessPoolExecutor(max_workers=processes) if processes > 0 else None
+        self.completed = deque()  # (job, future), appended to by the workers and drained by the loop
+        self.serial = {}  # serial key -> deque of jobs waiting for the one that's running
+        self.running = 0
+        self.read_fd, self.write_fd = os.pipe2(os.O_NONBLOCK | os.O_CLOEXEC)
+
+    def start(self, loop):
+        loop.register_exclusive(self.read_fd, self._completions, comment="Jobs")
+
+    def stop(self):
+        # waits for jobs that have started, a half finished zfs command is worse than a slow shutdown
+        self.thread_pool.shutdown(wait=True)
+        if self.process_pool is not None:
+            self.process_pool.shutdown(wait=False)
+        os.close(self.read_fd)
+        os.close(self.write_fd)
+
+    def submit(self, fn, *args, callback=None, serial=None, process=False):
+        """Call fn(*args) on a worker, then callback(result, exception) from the loop"""
+        job = Job(fn, args, callback, serial, process)
+        if serial is not None:
+            if serial in self.serial:
+                self.serial[serial].append(job)  # will be started when the one in front of it completes
+                return
+            self.serial[serial] = deque()
+        self._start(job)
+
+    def in_series(self, serial):
+        """True while a job in the given series is running or waiting"""
+        return serial in self.serial
+
+    def _start(self, job):
+        pool = self.process_pool if job.process and self.process_pool is not None else self.thread_pool
+        self.running += 1
+        future = pool.submit(job.fn, *job.args)
+        future.add_done_callback(lambda f: self._done(job, f))
+
+    def _done(self, job, future):
+        # on a worker thread (or the thread that submitted it, if it has finished already)
+        self.completed.append((job, future))
+        try:
+            os.write(self.write_fd, b'\0')
+        except OSError:
+            pass  # the pipe is full, so the loop is going to wake up anyway (or we're shutting down)
+
+    def _completions(self, fd):
+        try:
+            while len(os.read(fd, 4096)) == 4096:
+                pass
+        except BlockingIOError:
+            pass
+
+        while len(self.completed) != 0:
+            job, future = self.completed.popleft()
+            self.running -= 1
+
+            # start the next in the series
+            if job.serial is not None:
+                waiting = self.serial[job.serial]
+                if len(waiting) != 0:
+                    self._start(waiting.popleft())
+                else:
+                    del self.serial[job.serial]
+
+            # let the submitter know
+            exception = future.exception()
+            result = future.result() if exception is None else None
+            if job.callback is None:
+                if exception is not None:
+                    logging.error("Background job %s raised: %s" % (job.fn.__name__, str(exception)))
+                continue
+            try:
+                job.callback(result, exception)
+            except BaseException as e:
+                logging.error("Callback for background job %s raised: %s" % (job.fn.__name__, str(e)))
+
+    @staticmethod
+    def reply(msg, results, exception):
+        """Reply to msg with the results, or the exception if there was one"""
+        if exception is None:
+            msg.reply(results)
+            return
+        if not isinstance(exception, ValueError):
+            logging.error("Background job for %s failed: %s" % (msg.command.decode(), str(exception)))
+            exception = ValueError("There was a server failure")
+        msg.reply({'exception': str(exception)})
+
+    def __repr__(self):
+        return "<controller.jobs.Jobs object at %x (running=%d serial=%d)>" % \
+               (id(self), self.running, len(self.serial))
@@ -0,0 +1,115 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Always-on counters and latency histograms for the controller's commands"""
+
+# Recording is a couple of integer operations and a list increment, so this stays on in production.
+# Note that the latency is the time spent in the handler on the broker loop - for commands that reply
+# asynchronously (wait_tcp, claim_domain) it is the cost to the loop, not the time the client waits.
+
+from time import perf_counter
+
+
+class Histogram:
+    """Log-linear latency histogram - four buckets per power of two microseconds so at worst 25% error."""
+    slots = 128
+
+    def __init__(self):
+        self.counts = [0] * Histogram.slots
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, secs):
+        self.count += 1
+        self.total += secs
+        if secs > self.max:
+            self.max = secs
+        us = int(secs * 1000000)
+        if us < 4:
+            idx = us
+        else:
+            shift = us.bit_length() - 3
+            idx = (shift + 1) * 4 + ((us >> shift) & 3)
+            if idx >= Histogram.slots:
+                idx = Histogram.slots - 1
+        self.counts[idx] += 1
+
+    def percentile(self, pc):
+        """Returns the upper bound (in seconds) of the bucket holding the given percentile"""
+        if self.count == 0:
+            return 0.0
+        threshold = self.count * pc / 100
+        running = 0
+        for idx, count in enumerate(self.counts):
+            running += count
+            if running >= threshold:
+                return min(Histogram.upper_bound(idx), self.max)
+        return self.max
+
+    @staticmethod
+    def upper_bound(idx):
+        if idx < 4:
+            return (idx + 1) / 1000000
+        shift = idx // 4 - 1
+        return ((4 + idx % 4 + 1) << shift) / 1000000
+
+
+class CommandStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+    def state(self):
+        ms = 1000
+        return {'calls': self.calls,
+                'errors': self.errors,
+                'mean_ms': (self.latency.total / self.latency.count) * ms if self.latency.count != 0 else 0.0,
+                'p50_ms': self.latency.percentile(50) * ms,
+                'p95_ms': self.latency.percentile(95) * ms,
+                'p99_ms': self.latency.percentile(99) * ms,
+                'max_ms': self.latency.max * ms}
+
+
+class CommandMetrics:
+    """Per-command, per-origin (node or client) statistics"""
+    def __init__(self):
+        self.stats = {'node': {}, 'client': {}}
+
+    def instrument(self, command, handler, origin):
+        """Wrap a handler so it records calls, errors and latency.
+        origin is passed the message and returns either 'node' or 'client'."""
+        node_stats = self.stats['node'].setdefault(command, CommandStats())
+        client_stats = self.stats['client'].setdefault(command, CommandStats())
+
+        def instrumented(msg):
+            stats = node_stats if origin(msg) == 'node' else client_stats
+            stats.calls += 1
+            start = perf_counter()
+            try:
+                return handler(msg)
+            except BaseException:
+                stats.errors += 1
+                raise
+            finally:
+                stats.latency.record(perf_counter() - start)
+
+        return instrumented
+
+    def state(self):
+        # list() because we're being called from the inspection thread
+        return {origin: {command: stats.state() for command, stats in list(commands.items()) if stats.calls != 0}
+                for origin, commands in self.stats.items()}
+
+    def __repr__(self):
+        return "<controller.metrics.CommandMetrics object at %x>" % id(self)
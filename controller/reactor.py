@@ -0,0 +1,69 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""An epoll set that sits in the message loop as a single file descriptor"""
+
+# The messidge loop only polls for readability, one registration per fd. An epoll fd becomes readable when any
+# fd in its set is ready so we can register that instead, which gives us write readiness (non-blocking connects,
+# flushing queued data) and means thousands of sockets cost the loop's poller exactly one entry.
+# handlers have the signature handler(fd, events) where events is the epoll event mask.
+
+import logging
+import select
+import traceback
+
+
+class Reactor:
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.handlers = {}  # fd -> handler
+
+    def start(self, loop):
+        loop.register_exclusive(self.epoll.fileno(), self._events, comment="Reactor")
+
+    def stop(self):
+        self.epoll.close()
+
+    def register(self, fd, handler, *, read=True, write=False):
+        self.epoll.register(fd, Reactor._mask(read, write))
+        self.handlers[fd] = handler
+
+    def modify(self, fd, *, read=True, write=False):
+        self.epoll.modify(fd, Reactor._mask(read, write))
+
+    def unregister(self, fd):
+        """Call *before* closing the socket"""
+        try:
+            del self.handlers[fd]
+            self.epoll.unregister(fd)
+        except (KeyError, OSError, ValueError):
+            pass
+
+    def _events(self, fd):
+        # level triggered so anything we don't get to this time will be there next time
+        for fd, events in self.epoll.poll(0, 1024):
+            try:
+                handler = self.handlers[fd]
+            except KeyError:
+                continue
+            try:
+                handler(fd, events)
+            except BaseException:
+                # one misbehaving socket must not take the (exit_on_exception) loop down with it
+                logging.error("Reactor handler for fd %d raised: %s" % (fd, traceback.format_exc()))
+
+    @staticmethod
+    def _mask(read, write):
+        return (select.EPOLLIN if read else 0) | (select.EPOLLOUT if write else 0)
+
+    def __repr__(self):
+        return "<controller.reactor.Reactor object at %x (fds=%d)>" % (id(self), len(self.handlers))
@@ -0,0 +1,183 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Non-blocking TXT lookups driven from the broker's message loop"""
+
+# Queries go out over UDP on a non-blocking socket that is registered with the loop, so the loop never waits
+# on a slow authoritative server. Answers (including 'there is no such record') are cached by TTL.
+# callbacks have the signature callback(records, error) - records is a list of TXT records (each a list of bytes)
+# and error is None unless the lookup failed, in which case it's a string.
+
+import logging
+import random
+import socket
+import time
+import weakref
+from DNS import Base, Lib, Type, Class, Opcode
+
+
+class Query:
+    def __init__(self, name):
+        self.name = name
+        self.tid = random.randint(0, 65535)
+        self.server = 0  # index into the list of name servers
+        self.skt = None
+        self.timer = None
+
+    def packet(self):
+        m = Lib.Mpacker()
+        m.addHeader(self.tid, 0, Opcode.QUERY, 0, 0, 1, 0, 0, 0, 1, 0, 0, 0)
+        m.addQuestion(self.name, Type.TXT, Class.IN)
+        return m.getbuf()
+
+
+class Resolver:
+    def __init__(self, timers, *, timeout=5, max_ttl=300, negative_ttl=30):
+        self.timers = timers
+        self.timeout = timeout  # per server
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl  # short because the user is probably about to create the record
+        self.loop = None
+        self.cache = {}  # name -> (expires, records, error)
+        self.queries = {}  # fd -> Query
+        self.callbacks = {}  # name -> [callback, ...] so concurrent lookups for one name share a query
+
+    def start(self, loop):
+        self.loop = weakref.ref(loop)
+
+    def stop(self):
+        for query in list(self.queries.values()):
+            self._close(query)
+
+    def txt(self, name, callback):
+        """Look up the TXT records for name, callback happens from the message loop"""
+        # cached?
+        if len(self.cache) > 1024:
+            now = time.time()
+            self.cache = {n: entry for n, entry in self.cache.items() if entry[0] > now}
+        try:
+            expires, records, error = self.cache[name]
+            if expires > time.time():
+                logging.debug("DNS cache hit for: " + name)
+                callback(records, error)
+                return
+            del self.cache[name]
+        except KeyError:
+            pass
+
+        # already in flight?
+        if name in self.callbacks:
+            self.callbacks[name].append(callback)
+            return
+        self.callbacks[name] = [callback]
+        self._send(Query(name))
+
+    def _timed_out(self, query):
+        query.timer = None
+        logging.info("DNS query for %s timed out against: %s" % (query.name, self._servers()[query.server]))
+        self._next_server(query, "DNS lookup timed out for " + query.name)
+
+    def _servers(self):
+        if len(Base.defaults['server']) == 0:
+            Base.DiscoverNameServers()
+        return Base.defaults['server']
+
+    def _send(self, query):
+        server = self._servers()[query.server]
+        query.skt = socket.socket(socket.AF_INET6 if ':' in server else socket.AF_INET, socket.SOCK_DGRAM)
+        query.skt.setblocking(False)
+        try:
+            query.skt.connect((server, Base.defaults['port']))
+            query.skt.send(query.packet())
+        except OSError as e:
+            logging.info("Could not send DNS query to %s: %s" % (server, str(e)))
+            query.skt.close()
+            query.skt = None
+            self._next_server(query, "Could not send DNS query for " + query.name)
+            return
+        self.queries[query.skt.fileno()] = query
+        self.loop().register_exclusive(query.skt.fileno(), self._incoming, comment="DNS " + query.name)
+        query.timer = self.timers.call_later(self.timeout, self._timed_out, query)
+
+    def _incoming(self, fd):
+        try:
+            query = self.queries[fd]
+        except KeyError:
+            return
+        try:
+            reply = query.skt.recv(65535)
+        except BlockingIOError:
+            return
+        except OSError as e:  # most likely ICMP port unreachable
+            self._next_server(query, "DNS server failed: " + str(e))
+            return
+
+        # is this the answer to our question?
+        try:
+            result = Lib.DnsResult(Lib.Munpacker(reply), {})
+        except (Base.DNSError, IndexError) as e:
+            logging.info("Could not unpack DNS reply for %s: %s" % (query.name, str(e)))
+            return
+        if result.header['id'] != query.tid or result.header['qr'] != 1:
+            return  # not for us, keep waiting
+
+        # the actual answer
+        status = result.header['status']
+        if status == 'NOERROR':
+            answers = [a for a in result.answers if a['typename'] == 'TXT']
+            if len(answers) != 0:
+                ttl = min(self.max_ttl, min(a['ttl'] for a in answers))
+            else:
+                ttl = self._negative_ttl(result)
+            self._finish(query, [a['data'] for a in answers], None, ttl)
+        elif status == 'NXDOMAIN':
+            self._finish(query, [], "DNS query status: NXDOMAIN", self._negative_ttl(result))
+        else:  # SERVFAIL, REFUSED etc. are the server's problem, not an answer
+            self._next_server(query, "DNS query status: " + status)
+
+    def _negative_ttl(self, result):
+        # RFC2308 - the TTL on the SOA in the authority section is how long to cache the absence of an answer
+        soas = [a['ttl'] for a in result.authority if a['typename'] == 'SOA']
+        return min([self.negative_ttl] + soas)
+
+    def _next_server(self, query, error):
+        self._close(query)
+        query.server += 1
+        if query.server < len(self._servers()):
+            self._send(query)
+        else:
+            self._finish(query, [], error, None)  # not cached, we didn't actually get an answer
+
+    def _finish(self, query, records, error, ttl):
+        self._close(query)
+        if ttl is not None and ttl > 0:
+            self.cache[query.name] = (time.time() + ttl, records, error)
+        for callback in self.callbacks.pop(query.name, []):
+            try:
+                callback(records, error)
+            except BaseException as e:
+                logging.error("DNS callback for %s raised: %s" % (query.name, str(e)))
+
+    def _close(self, query):
+        self.timers.cancel(query.timer)
+        query.timer = None
+        if query.skt is None:
+            return
+        fd = query.skt.fileno()
+        self.loop().unregister_exclusive(fd)
+        self.queries.pop(fd, None)
+        query.skt.close()
+        query.skt = None
+
+    def __repr__(self):
+        return "<controller.resolver.Resolver object at %x (in_flight=%d cached=%d)>" % \
+               (id(self), len(self.queries), len(self.cache))
@@ -0,0 +1,103 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Coalesces node performance counters and only passes on the changes that matter"""
+
+# The model's copy of the counters is always up to date (resource offers use it). What we hold back is telling
+# the clients and haproxy: updates are gathered for 'window' seconds, then any counter that has moved further than
+# its threshold since we last published it goes out to the clients as part of a single stats_delta message
+# {'nodes': {node_pk: {counter: value, ...}, ...}}. haproxy is only rebuilt if a server weight actually changed.
+# Clients that predate stats_delta get update_stats with the whole dict for the nodes that changed, unless
+# legacy_updates is turned off.
+
+import logging
+
+
+class StatsAggregator:
+    default_thresholds = {'cpu': 100, 'memory': 64, 'paging': 16, 'ave_start_time': 0.25}
+
+    def __init__(self, broker, model, timers, *, window=5, thresholds=None, relative=0.05, legacy_updates=True):
+        self.broker = broker
+        self.model = model
+        self.timers = timers
+        self.window = window
+        self.thresholds = thresholds if thresholds is not None else StatsAggregator.default_thresholds
+        self.relative = relative  # changes also need to be at least this fraction of the last published value
+        self.legacy_updates = legacy_updates
+        self.published = {}  # node pk -> {counter: value} as the clients last saw it
+        self.weights = {}  # node pk -> weight haproxy was last built with
+        self.pending = set()  # node pks that have reported since the last flush
+        self.timer = None
+
+    def updated(self, pk):
+        """A node has reported new counters (already written into the model)"""
+        self.pending.add(pk)
+        if self.timer is None:
+            self.timer = self.timers.call_later(self.window, self.flush)
+
+    def forget(self, pk):
+        self.pending.discard(pk)
+        self.published.pop(pk, None)
+        self.weights.pop(pk, None)
+
+    def flush(self):
+        self.timer = None
+        deltas = {}
+        rebuild = False
+        for pk in self.pending:
+            try:
+                node = self.model.nodes[pk]
+            except KeyError:
+                continue  # went away before we got to it
+
+            # significant changes
+            published = self.published.setdefault(pk, {})
+            delta = {counter: value for counter, value in node.perf_counters.items()
+                     if self._significant(counter, published.get(counter), value)}
+            if len(delta) != 0:
+                published.update(delta)
+                deltas[pk] = delta
+
+            # weights
+            weight = node.weight()
+            if self.weights.get(pk) != weight:
+                self.weights[pk] = weight
+                rebuild = True
+        self.pending = set()
+
+        # update server weights
+        if rebuild:
+            self.broker.proxy.rebuild()
+
+        # distribute to the sessions
+        if len(deltas) == 0:
+            return
+        logging.debug("Publishing stats for %d node(s)" % len(deltas))
+        self.model.offers.changed('nodes')  # offers carry the counters too
+        self.broker.broadcast_cmd(b'stats_delta', {'nodes': deltas})
+        if self.legacy_updates:
+            for pk in deltas.keys():
+                self.broker.broadcast_cmd(b'update_stats', {'node': pk, 'stats': self.published[pk]})
+
+    def _significant(self, counter, old, new):
+        if old is None:
+            return True
+        try:
+            change = abs(new - old)
+        except TypeError:
+            return new != old
+        threshold = self.thresholds.get(counter, 0)
+        return change > threshold and change >= abs(old) * self.relative
+
+    def __repr__(self):
+        return "<controller.stats.StatsAggregator object at %x (nodes=%d pending=%d)>" % \
+               (id(self), len(self.published), len(self.pending))
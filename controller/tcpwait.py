@@ -0,0 +1,164 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Waits for containers to start listening, without a thread per waiter"""
+
+# Each waiter makes non-blocking connects that complete through the reactor. A waiter that is between attempts
+# (or has an attempt outstanding for too long) holds a timer for when it next needs attention.
+
+import errno
+import logging
+import socket
+import time
+
+
+class Waiter:
+    def __init__(self, msg, ip, port, deadline, backoff, http):
+        self.msg = msg
+        self.ip = ip
+        self.port = port
+        self.deadline = deadline
+        self.backoff = backoff
+        self.http = http  # None, or the path to GET
+        self.attempts = 0
+        self.skt = None
+        self.probing = False  # connected and waiting for an http status line
+        self.received = b''
+        self.timer = None
+
+    def next_delay(self):
+        return self.backoff[min(self.attempts, len(self.backoff)) - 1]
+
+
+class TcpWaiter:
+    connect_timeout = 2  # seconds for a single attempt before we give up on it and try again
+    default_backoff = [0.5]  # last entry repeats
+
+    def __init__(self, reactor, timers):
+        self.reactor = reactor
+        self.timers = timers
+        self.waiters = {}  # fd -> Waiter, for those with a connection attempt in progress
+
+    def wait(self, msg, ip, port, *, timeout=30, backoff=None, http=None):
+        """Reply to msg when ip:port accepts a connection (and optionally answers 2xx/3xx for an http GET)"""
+        # these come from the client, ValueError gets the message replied to with an error
+        if not isinstance(port, int) or isinstance(port, bool) or not 0 < port < 65536:
+            raise ValueError("Port needs to be an integer between 1 and 65535")
+        if not TcpWaiter._positive(timeout):
+            raise ValueError("Timeout needs to be a positive number of seconds")
+        if backoff is not None and (not isinstance(backoff, (list, tuple)) or
+                                    not all(TcpWaiter._positive(delay) for delay in backoff)):
+            raise ValueError("Backoff needs to be a list of positive numbers of seconds")
+        if http is not None and (not isinstance(http, str) or '\r' in http or '\n' in http):
+            raise ValueError("Http needs to be the path to GET")
+        if backoff is None or len(backoff) == 0:
+            backoff = TcpWaiter.default_backoff
+        waiter = Waiter(msg, ip, port, time.time() + timeout, backoff, http)
+        self._attempt(waiter)
+
+    @staticmethod
+    def _positive(value):
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and 0 < value < float('inf')
+
+    def _wake(self, waiter):
+        waiter.timer = None
+        if waiter.skt is not None:  # attempt took too long
+            self._close(waiter)
+        if time.time() >= waiter.deadline:
+            self._finish(waiter, {'exception': 'Could not connect'})
+            return
+        self._attempt(waiter)
+
+    def _attempt(self, waiter):
+        waiter.attempts += 1
+        waiter.probing = False
+        waiter.received = b''
+        waiter.skt = socket.socket()
+        waiter.skt.setblocking(False)
+        err = waiter.skt.connect_ex((waiter.ip, waiter.port))
+        if err not in (0, errno.EINPROGRESS):
+            self._close(waiter)
+            self._schedule(waiter, time.time() + waiter.next_delay())
+            return
+        self.waiters[waiter.skt.fileno()] = waiter
+        self.reactor.register(waiter.skt.fileno(), self._event, read=False, write=True)
+        self._schedule(waiter, time.time() + TcpWaiter.connect_timeout)
+
+    def _event(self, fd, events):
+        try:
+            waiter = self.waiters[fd]
+        except KeyError:
+            return
+
+        # has the connect completed?
+        if not waiter.probing:
+            if waiter.skt.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) != 0:
+                self._retry(waiter)
+                return
+            if waiter.http is None:
+                self._finish(waiter)
+                return
+            request = "GET %s HTTP/1.0\r\nHost: %s\r\n\r\n" % (waiter.http, waiter.ip)
+            try:
+                waiter.skt.send(request.encode())
+            except OSError:
+                self._retry(waiter)
+                return
+            waiter.probing = True
+            self.reactor.modify(fd, read=True, write=False)
+            return
+
+        # reading the status line of the http probe
+        try:
+            data = waiter.skt.recv(1024)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        waiter.received += data
+        if b'\r\n' not in waiter.received:
+            if len(data) == 0 or len(waiter.received) > 1024:
+                self._retry(waiter)  # closed (or garbage) before we got a status
+            return
+        parts = waiter.received.split(b' ')
+        if len(parts) > 1 and parts[1][:1] in (b'2', b'3'):
+            self._finish(waiter)
+        else:
+            self._retry(waiter)
+
+    def _retry(self, waiter):
+        self._close(waiter)
+        wake_at = time.time() + waiter.next_delay()
+        self._schedule(waiter, wake_at if wake_at < waiter.deadline else waiter.deadline)
+
+    def _schedule(self, waiter, wake_at):
+        self.timers.cancel(waiter.timer)
+        waiter.timer = self.timers.call_at(wake_at, self._wake, waiter)
+
+    def _finish(self, waiter, results=None):
+        self._close(waiter)
+        self.timers.cancel(waiter.timer)
+        waiter.timer = None
+        waiter.msg.reply(results)
+        logging.debug("Finished waiting for %s:%d after %d attempt(s)" % (waiter.ip, waiter.port, waiter.attempts))
+
+    def _close(self, waiter):
+        if waiter.skt is None:
+            return
+        fd = waiter.skt.fileno()
+        self.reactor.unregister(fd)
+        self.waiters.pop(fd, None)
+        waiter.skt.close()
+        waiter.skt = None
+
+    def __repr__(self):
+        return "<controller.tcpwait.TcpWaiter object at %x (connecting=%d)>" % (id(self), len(self.waiters))
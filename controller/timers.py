@@ -0,0 +1,84 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""A deadline heap for things that need to happen at (or after) a given time"""
+
+# Runs from the loop's idle hook so an idle pass with nothing due costs a single comparison.
+# The loop calls idle tasks when a poll times out (<=0.5s) or every five seconds when busy, so
+# timers fire at or after their deadline but should not be relied on for better than that.
+# Cancellation just marks the timer, it gets discarded when it reaches the top of the heap.
+
+import heapq
+import logging
+import time
+import traceback
+from itertools import count
+
+
+class Timer:
+    __slots__ = ('when', 'callback', 'args', 'cancelled')
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+
+class Timers:
+    def __init__(self):
+        self.heap = []  # (when, sequence, Timer)
+        self.sequence = count()  # so timers with the same deadline never get compared
+        self.cancelled = 0
+
+    def start(self, loop):
+        loop.register_on_idle(self.run_due)
+
+    def call_at(self, when, callback, *args):
+        """Call callback(*args) at or after 'when' (as time.time()), returns a Timer that can be cancelled"""
+        timer = Timer(when, callback, args)
+        heapq.heappush(self.heap, (when, next(self.sequence), timer))
+        return timer
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def cancel(self, timer):
+        if timer is None or timer.cancelled:
+            return
+        timer.cancelled = True
+        self.cancelled += 1
+
+        # stop cancelled timers from dominating the heap
+        if self.cancelled > 1024 and self.cancelled > len(self.heap) // 2:
+            self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+
+    def run_due(self):
+        now = time.time()
+        while len(self.heap) != 0 and self.heap[0][0] <= now:
+            timer = heapq.heappop(self.heap)[2]
+            if timer.cancelled:
+                self.cancelled = max(0, self.cancelled - 1)
+                continue
+            timer.cancelled = True  # so cancelling a timer that has already fired is harmless
+            try:
+                timer.callback(*timer.args)
+            except BaseException:
+                logging.error("Timer callback raised: " + traceback.format_exc())
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def __repr__(self):
+        return "<controller.timers.Timers object at %x (pending=%d)>" % (id(self), len(self))
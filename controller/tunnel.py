@@ -12,14 +12,85 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """A 'forward' tunnel onto a container"""
 # Note that the passed parameter "proxy" always refers to the remote end
+# Each connection the client makes through the tunnel is a Proxy: our socket onto the container, keyed by the fd the
+# client uses for it. Data for the container is appended to the proxy's outbound queue and written as the socket
+# will take it, the reactor tells us when it will take more - so nothing is dropped however far behind the
+# container gets. Past 'high_water' queued bytes the client is sent pause_proxy, and resume_proxy once it has
+# drained below 'low_water'. Data sent before the connection completes just waits in the queue.
+# Going the other way, a client can ask for flow control by granting a proxy credit (grant_proxy): from then on we
+# only read as many bytes from the container as the client has granted, and when the credit runs out we stop
+# reading the socket altogether until more arrives. The data waits in the kernel, tcp pushes back on the container,
+# and however slow the client is the broker holds nothing extra. Grants have to be a positive number of bytes and
+# credit accumulates only up to 'max_credit'. Proxies that have never been granted credit are read as fast as the
+# container writes, as before.
+# A proxy that can't connect (usually because the container isn't listening yet) tries again on a timer, backing
+# off exponentially with some jitter so a crowd of them don't all retry together, until the tunnel's timeout. When
+# any proxy connects the container is evidently up, so the others waiting on the same tunnel try again immediately.
+# Every open proxy, across all the tunnels, is also known to the broker's ProxyReaper. Proxies that have carried no
+# data for 'idle_timeout' are closed from a timer, and if opening one more would take us past 'max_open' the least
+# recently used is closed to make room - so abandoned clients can't run the broker out of file descriptors. The
+# client is sent close_proxy for anything closed this way.
+# Data coming back from the container is read straight into one shared buffer (the loop only reads one socket at a
+# time) and goes to the client in messages of up to 'read size' bytes. The read size for each proxy starts small
+# and doubles every time a message fills it, so interactive traffic stays snappy and bulk transfers become a few
+# large messages rather than a flood of small ones. A proxy is drained up to 'pass_budget' bytes per event, after
+# which the loop gets on with something else and (being level triggered) comes back for the rest.
 
+import os
 import time
 import logging
+import random
+import resource
+import select
 import socket
 import weakref
+from collections import deque, OrderedDict
+
+
+class Proxy:
+    """One connection through the tunnel"""
+    def __init__(self, remote_fd, msg):
+        self.remote_fd = remote_fd
+        self.msg = msg  # the message that opened it, any failure to connect is the reply
+        self.socket = None
+        self.fd = None
+        self.connected = False
+        self.outbound = deque()  # bytes (or a memoryview of what's left of them) waiting to go to the container
+        self.queued = 0
+        self.paused = False  # the client has been asked to stop sending
+        self.read_size = Tunnel.min_read
+        self.credit = None  # bytes the client will take, None if it doesn't do flow control
+        self.attempts = 0  # failed connects
+        self.timer = None  # for the next attempt
+        self.opened = time.time()
+        self.last_active = self.opened
+
+    def new_socket(self):
+        self.socket = socket.socket()
+        self.socket.setblocking(False)
+        self.fd = self.socket.fileno()
+
+    def state(self):
+        return {'connected': self.connected, 'queued': self.queued, 'paused': self.paused, 'credit': self.credit}
+
+    def reading(self):
+        return self.credit is None or self.credit > 0
+
+    def __repr__(self):
+        return "<controller.tunnel.Proxy object at %x (remote_fd=%d fd=%s queued=%d)>" % \
+               (id(self), self.remote_fd, str(self.fd), self.queued)
 
 
 class Tunnel:
+    min_read = 4096
+    max_read = 256 * 1024
+    pass_budget = 1024 * 1024
+    read_buffer = bytearray(max_read)
+    high_water = 1024 * 1024
+    low_water = 256 * 1024
+    max_credit = 64 * 1024 * 1024
+    retry_initial = 0.05
+    retry_max = 2
 
     def __init__(self, uuid, parent, broker, loop, ip, port, timeout):
         logging.debug("Creating tunnel onto: %s:%s" % (ip, port))
@@ -30,11 +101,12 @@ class Tunnel:
         self.ip = ip
         self.port = port
         self.timeout = timeout
-        self.apparently_connected = {}
-        self.proxies = {}  # map of local fd to the socket object
-        self.remotepxyfd_localpxyfd = {}  # a map of remote proxy fd to local
-        self.localpxyfd_remotepxyfd = {}  # a map of local proxy fd to remote
-        self.retries = {}  # remotepxy to a list of method calls to be retried (usually waiting for tcp handshake)
+        self.proxies = {}  # remote fd -> Proxy
+        self.waiting = set()  # remote fd's of proxies with a timer to retry connecting
+        self.retries = 0
+        self.connects = 0
+        self.connect_time_total = 0
+        self.connect_time_max = 0
 
     def as_dict(self):
         return {'uuid': self.uuid, "ip": self.ip, "port": self.port, "timeout": self.timeout}
@@ -49,14 +121,13 @@ class Tunnel:
         self.loop = weakref.ref(loop)
 
     def disconnect(self):
-        self.loop().unregister_on_idle(self.retry)  # might be because of retries
         self.disconnect_all_proxies()
         self.broker = None
         self.loop = None
 
     def disconnect_all_proxies(self):
         logging.debug("Marking all proxies as being disconnected for: " + self.uuid.decode())
-        for proxy in list(self.remotepxyfd_localpxyfd.keys()):
+        for proxy in list(self.proxies.keys()):
             self.close_proxy(proxy)
 
     def forward(self, msg):
@@ -64,120 +135,286 @@ class Tunnel:
         remotepxyfd = msg.params['proxy']
 
         # do we need to create a fresh connection?
-        if remotepxyfd not in self.remotepxyfd_localpxyfd:
-            self.apparently_connected[remotepxyfd] = False
-            proxy = socket.socket()
-            proxy.setblocking(False)
-            localpxyfd = proxy.fileno()
-            self.proxies[localpxyfd] = proxy
-            self.remotepxyfd_localpxyfd[remotepxyfd] = localpxyfd
-            self.localpxyfd_remotepxyfd[localpxyfd] = remotepxyfd
-            self.loop().register_exclusive(localpxyfd, self.incoming)
-
-        if not self.apparently_connected[remotepxyfd]:
-            localpxyfd = self.remotepxyfd_localpxyfd[remotepxyfd]
-            proxy = self.proxies[localpxyfd]
-            logging.debug("Opening a new proxy from remotepxyfd=%d to localpxyfd=%d" % (remotepxyfd, localpxyfd))
-            try:
-                proxy.connect((self.ip, self.port))
-            except (ConnectionRefusedError, ConnectionAbortedError):
-                logging.debug("Connection refused, queueing: " + str(msg))
-                self.queue_for_retry(remotepxyfd, msg)
-                return
-            except BlockingIOError:
-                pass
-                # it throws to let us know the operation is in progress. thanks, Ray.
+        proxy = self.proxies.get(remotepxyfd)
+        if proxy is None:
+            proxy = Proxy(remotepxyfd, msg)
+            self.proxies[remotepxyfd] = proxy
+            self.broker().reaper.opened(self, proxy)
+            self._connect(proxy)
+        else:
+            self.broker().reaper.touched(proxy)
 
-        # send the data
-        localpxyfd = self.remotepxyfd_localpxyfd[remotepxyfd]
-        try:
-            self.proxies[localpxyfd].sendall(msg.bulk)
-            logging.debug("Proxy delivered data: " + str(localpxyfd))
-            self.apparently_connected[remotepxyfd] = True
-        except OSError as e:
-            # queue for retry.
-            if e.errno in (11, 32, 134, 111):
-                logging.debug("Sendall gave err (%s) for fd: %s" % (str(e), str(localpxyfd)))
-                self.queue_for_retry(remotepxyfd, msg)
-            else:
-                msg.reply({'exception': 'Something unexpected happened connecting the proxy'})
-                logging.warning("Connecting (%s:%s) threw: %s" % (self.ip, self.port, str(e)))
+        # queue the data, and send now if we can
+        if len(msg.bulk) != 0:
+            proxy.outbound.append(msg.bulk)
+            proxy.queued += len(msg.bulk)
+            if proxy.connected:
+                self._flush(proxy)
+            if proxy.queued > Tunnel.high_water and not proxy.paused and proxy.remote_fd in self.proxies:
+                logging.debug("Proxy over the high water mark, pausing: " + str(remotepxyfd))
+                proxy.paused = True
+                self._to_client(b'pause_proxy', proxy)
 
-    def incoming(self, localpxyfd):
-        """Send data that has come in through a proxy back to the client."""
-        try:
-            remotepxy = self.localpxyfd_remotepxyfd[localpxyfd]
-        except KeyError:
-            logging.debug("Trying to send data back for proxy that has been closed: " + str(localpxyfd))
-            return
+    def grant(self, remotepxyfd, credit):
+        """The client can take another 'credit' bytes from this proxy"""
+        if not isinstance(credit, int) or isinstance(credit, bool) or credit <= 0:
+            raise ValueError("Proxy credit needs to be a positive integer number of bytes")
+        proxy = self.proxies[remotepxyfd]
+        was_reading = proxy.credit is not None and proxy.credit > 0
+        proxy.credit = min(Tunnel.max_credit, credit if proxy.credit is None else proxy.credit + credit)
+        if proxy.connected and not was_reading:
+            self._interest(proxy)
 
-        # otherwise we should be all good
-        try:
-            bulk = self.proxies[localpxyfd].recv(8192)
-        except (ConnectionRefusedError, ConnectionResetError, ConnectionAbortedError, TimeoutError, OSError) as e:
-            # may be receiving a closed event because the container is rebooting
-            # these get marked as not being connected as part of disconnect_all_proxies
-            # (itself part of rebooting a container)
-            if not self.apparently_connected[remotepxy]:
-                return
-            logging.debug("Connection failed on recv, treating as if the socket was closed: " + str(localpxyfd))
-            bulk = b''
+    def incoming(self, proxy):
+        """Send data that has come in through a proxy back to the client."""
+        # read as much as we're allowed to, sending each time the buffer fills
+        limit = Tunnel.pass_budget if proxy.credit is None else min(Tunnel.pass_budget, proxy.credit)
+        size = proxy.read_size
+        view = memoryview(Tunnel.read_buffer)
+        filled = 0
+        total = 0
+        closed = False
+        while total < limit:
+            try:
+                received = proxy.socket.recv_into(view[filled:min(size, filled + limit - total)])
+            except BlockingIOError:
+                break
+            except OSError:
+                logging.debug("Connection failed on recv, treating as if the socket was closed: " + str(proxy.fd))
+                received = 0
+            if received == 0:
+                closed = True
+                break
+            filled += received
+            total += received
+            if filled == size:
+                self._to_client(b'from_proxy', proxy, view[:filled])
+                filled = 0
+                size = min(size * 2, Tunnel.max_read)
+        if filled != 0:
+            self._to_client(b'from_proxy', proxy, view[:filled])
+        if total != 0:
+            self.broker().reaper.touched(proxy)
+        if total < size // 4:
+            size = max(size // 2, Tunnel.min_read)  # gone quiet, stop asking for big reads
+        proxy.read_size = size
 
         # is this a socket close event
-        if len(bulk) == 0:
-            if not self.apparently_connected[remotepxy]:
-                return
-            logging.debug("Proxy has been closed server side, sending notification: " + str(localpxyfd))
-            self.close_proxy(remotepxy)
+        if closed:
+            logging.debug("Proxy has been closed server side, sending notification: " + str(proxy.fd))
+            self._closed_by_container(proxy)
             return
 
-        # OK, then
-        self.broker().send_cmd(self.parent().rid, b'from_proxy', {'proxy': remotepxy}, bulk=bulk, uuid=self.uuid)
-        logging.debug("Proxy returned data: " + str(localpxyfd))
+        # out of credit?
+        if proxy.credit is not None:
+            proxy.credit -= total
+            if proxy.credit == 0:
+                logging.debug("Proxy out of credit, no longer reading: " + str(proxy.remote_fd))
+                self._interest(proxy)
 
-    def retry(self):
-        """See if we have any messages to retry"""
-        self.loop().unregister_on_idle(self.retry)  # will be re-registered if a forward fails again
-        for proxy, waiting in list(self.retries.items()):
-            del self.retries[proxy]
-            self.forward(waiting)
+    def retry(self, proxy):
+        """Try connecting again"""
+        proxy.timer = None
+        self.waiting.discard(proxy.remote_fd)
+        if self.proxies.get(proxy.remote_fd) is proxy:
+            self._connect(proxy)
 
     def close_proxy(self, remotepxyfd):
         """Close a single proxy"""
         logging.debug("...closing proxy connection remote fd: " + str(remotepxyfd))
-        localpxyfd = self.remotepxyfd_localpxyfd[remotepxyfd]
-        proxy = self.proxies[localpxyfd]  # the actual socket
-        proxy.close()
-        if remotepxyfd in list(self.retries):
-            del self.retries[remotepxyfd]
-        del self.remotepxyfd_localpxyfd[remotepxyfd]
-        del self.localpxyfd_remotepxyfd[localpxyfd]
-        del self.proxies[localpxyfd]
-        del self.apparently_connected[remotepxyfd]
-        self.loop().unregister_exclusive(localpxyfd)
-        return
-
-    def queue_for_retry(self, remotepxyfd, msg):
+        proxy = self.proxies.pop(remotepxyfd)
+        self.waiting.discard(remotepxyfd)
+        self.broker().timers.cancel(proxy.timer)
+        self.broker().reaper.closed(proxy)
+        self._close_socket(proxy)
+
+    def reap(self, proxy):
+        """Close a proxy on the broker's initiative, and tell the client"""
+        self.close_proxy(proxy.remote_fd)
+        self._to_client(b'close_proxy', proxy)
+
+    def queue_for_retry(self, proxy):
         # timeout?
-        if msg.time is None:
-            msg.time = time.time()
-        if time.time() - msg.time > self.timeout:
+        if time.time() - proxy.opened > self.timeout:
             failure = "Tunnel (%s) timed out trying to connect to: %s:%s" % (self.uuid, self.ip, self.port)
             logging.info(failure)
-            self.close_proxy(remotepxyfd)
-            msg.reply(results={'exception': failure})
+            self.close_proxy(proxy.remote_fd)
+            proxy.msg.reply(results={'exception': failure})
             return
 
         # OK, go ahead
-        logging.debug("Queued a retry (at %f secs) for remote fd: %s" % (time.time() - msg.time, str(remotepxyfd)))
-        self.retries[remotepxyfd] = msg
-        self.loop().register_on_idle(self.retry)
-
-        # debug
-        logging.debug("Retry queue: " + str(self.retries))
+        delay = min(Tunnel.retry_max, Tunnel.retry_initial * 2 ** proxy.attempts) * random.uniform(0.5, 1)
+        proxy.attempts += 1
+        self.retries += 1
+        logging.debug("Queued a retry (at %f secs, in %f) for remote fd: %s" %
+                      (time.time() - proxy.opened, delay, str(proxy.remote_fd)))
+        self.waiting.add(proxy.remote_fd)
+        proxy.timer = self.broker().timers.call_later(delay, self.retry, proxy)
 
     def state(self):
-        return {'dest_ip_port': (self.ip, self.port), 'apparently_connected': self.apparently_connected}
+        return {'dest_ip_port': (self.ip, self.port),
+                'proxies': {remote_fd: proxy.state() for remote_fd, proxy in self.proxies.items()},
+                'retries': self.retries,
+                'connects': self.connects,
+                'connect_time_mean': self.connect_time_total / self.connects if self.connects != 0 else None,
+                'connect_time_max': self.connect_time_max}
+
+    def _connect(self, proxy):
+        # a fresh socket for each attempt, the connect completes (or fails) when the reactor says it's writable
+        self._close_socket(proxy)
+        proxy.new_socket()
+        logging.debug("Opening a new proxy from remotepxyfd=%d to localpxyfd=%d" % (proxy.remote_fd, proxy.fd))
+        try:
+            proxy.socket.connect((self.ip, self.port))
+        except BlockingIOError:
+            pass  # it throws to let us know the operation is in progress. thanks, Ray.
+        except (ConnectionRefusedError, ConnectionAbortedError):
+            logging.debug("Connection refused, queueing: " + str(proxy.remote_fd))
+            self.queue_for_retry(proxy)
+            return
+        except OSError as e:
+            logging.warning("Connecting (%s:%s) threw: %s" % (self.ip, self.port, str(e)))
+            self.close_proxy(proxy.remote_fd)
+            proxy.msg.reply({'exception': 'Something unexpected happened connecting the proxy'})
+            return
+        self.broker().reactor.register(proxy.fd, lambda fd, events: self._event(proxy, events), read=True, write=True)
+
+    def _event(self, proxy, events):
+        if not proxy.connected:
+            error = proxy.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error != 0:
+                logging.debug("Connection failed (%d), queueing: %s" % (error, str(proxy.remote_fd)))
+                self._close_socket(proxy)
+                self.queue_for_retry(proxy)
+                return
+            if not events & select.EPOLLOUT:
+                return
+            self._connected(proxy)
+        if events & select.EPOLLOUT:
+            self._flush(proxy)
+        if proxy.remote_fd not in self.proxies:
+            return
+        if events & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+            if proxy.reading():
+                self.incoming(proxy)
+            elif events & (select.EPOLLHUP | select.EPOLLERR):
+                self._closed_by_container(proxy)  # reported even though we're not reading, and won't go away
+
+    def _connected(self, proxy):
+        proxy.connected = True
+        connect_time = time.time() - proxy.opened
+        self.connects += 1
+        self.connect_time_total += connect_time
+        self.connect_time_max = max(self.connect_time_max, connect_time)
+        logging.debug("Proxy connected after %f secs and %d retries: %s" %
+                      (connect_time, proxy.attempts, str(proxy.remote_fd)))
+
+        # the container is listening now, so anything waiting to retry can go now
+        for remote_fd in list(self.waiting):
+            waiting = self.proxies[remote_fd]
+            self.broker().timers.cancel(waiting.timer)
+            self.retry(waiting)
+
+    def _flush(self, proxy):
+        # write as much of the queue as the socket will take, and ask to hear when it will take more
+        while len(proxy.outbound) != 0:
+            data = proxy.outbound[0]
+            try:
+                sent = proxy.socket.send(data)
+            except BlockingIOError:
+                break
+            except OSError as e:
+                logging.debug("Send gave err (%s) for fd: %s" % (str(e), str(proxy.fd)))
+                self._closed_by_container(proxy)
+                return
+            proxy.queued -= sent
+            if sent == len(data):
+                proxy.outbound.popleft()
+            else:
+                proxy.outbound[0] = memoryview(data)[sent:]
+        self._interest(proxy)
+        if proxy.paused and proxy.queued < Tunnel.low_water:
+            logging.debug("Proxy below the low water mark, resuming: " + str(proxy.remote_fd))
+            proxy.paused = False
+            self._to_client(b'resume_proxy', proxy)
+
+    def _interest(self, proxy):
+        # once connected: readable if we have credit, writable if there's something to write
+        self.broker().reactor.modify(proxy.fd, read=proxy.reading(), write=len(proxy.outbound) != 0)
+
+    def _closed_by_container(self, proxy):
+        self.close_proxy(proxy.remote_fd)
+        self._to_client(b'close_proxy', proxy)
+
+    def _close_socket(self, proxy):
+        if proxy.socket is None:
+            return
+        self.broker().reactor.unregister(proxy.fd)
+        proxy.socket.close()
+        proxy.socket = None
+        proxy.fd = None
+        proxy.connected = False
+
+    def _to_client(self, command, proxy, data=b''):
+        self.broker().send_cmd(self.parent().rid, command, {'proxy': proxy.remote_fd}, bulk=bytes(data),
+                               uuid=self.uuid)
 
     def __repr__(self):
         return "<controller.tunnel.Tunnel object at %x (%s:%s - uuid=%s)>" % (id(self), self.ip, self.port, self.uuid)
+
+
+class ProxyReaper:
+    """Closes proxies that have gone idle, and the least recently used when there are too many open"""
+    def __init__(self, timers, *, idle_timeout=3600, max_open=None, sweep_interval=60):
+        self.timers = timers
+        self.idle_timeout = idle_timeout
+        self.max_open = max_open if max_open is not None else resource.getrlimit(resource.RLIMIT_NOFILE)[0] // 2
+        self.sweep_interval = sweep_interval
+        self.proxies = OrderedDict()  # proxy -> tunnel, least recently active first
+        self.reaped = 0
+        self.reclaimed = 0
+
+    def start(self):
+        self.timers.call_later(self.sweep_interval, self.sweep)
+
+    def opened(self, tunnel, proxy):
+        while len(self.proxies) >= self.max_open:
+            lru, lru_tunnel = next(iter(self.proxies.items()))
+            logging.info("Too many open proxies, closing the least recently used: " + lru_tunnel.uuid.decode())
+            self.reclaimed += 1
+            lru_tunnel.reap(lru)  # which calls closed
+        self.proxies[proxy] = tunnel
+
+    def touched(self, proxy):
+        proxy.last_active = time.time()
+        try:
+            self.proxies.move_to_end(proxy)
+        except KeyError:
+            pass
+
+    def closed(self, proxy):
+        self.proxies.pop(proxy, None)
+
+    def sweep(self):
+        # oldest first, so stops at the first one that's still in use
+        expire = time.time() - self.idle_timeout
+        while len(self.proxies) != 0:
+            proxy, tunnel = next(iter(self.proxies.items()))
+            if proxy.last_active > expire:
+                break
+            logging.info("Closing idle proxy on tunnel: " + tunnel.uuid.decode())
+            self.reaped += 1
+            tunnel.reap(proxy)
+        self.timers.call_later(self.sweep_interval, self.sweep)
+
+    def state(self):
+        try:
+            fds = len(os.listdir('/proc/self/fd'))
+        except OSError:
+            fds = None
+        return {'open_proxies': len(self.proxies), 'max_open': self.max_open, 'open_fds': fds,
+                'fd_limit': resource.getrlimit(resource.RLIMIT_NOFILE)[0],
+                'reaped_idle': self.reaped, 'reclaimed': self.reclaimed}
+
+    def __repr__(self):
+        return "<controller.tunnel.ProxyReaper object at %x (open=%d)>" % (id(self), len(self.proxies))
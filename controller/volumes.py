@@ -30,14 +30,14 @@ class Volume(Taggable):
         return 'tf/vol-' + self.uuid.decode()
 
     @staticmethod
-    def create(user, uuid, tag, async):
+    def create(user, uuid, tag, asynchronous):
         name = 'tf/vol-' + uuid.decode()
         user_ascii = b64encode(user).decode()[:-1]
         zfs_reply = check_output(['zfs', 'create',
                                   '-o', 'recordsize=8k',
                                   '-o', 'atime=off',
                                   '-o', Volume.share_options,
-                                  '-o', 'sync=' + ('disabled' if async else 'standard'),
+                                  '-o', 'sync=' + ('disabled' if asynchronous else 'standard'),
                                   '-o', ':user=' + user_ascii,
                                   '-o', ':tag=' + (tag.decode() if tag is not None else '-'),
                                   name])
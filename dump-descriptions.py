@@ -14,8 +14,10 @@
 import sqlite3
 import cbor
 import json
+from model.descriptions import decompress
 
 conn = sqlite3.connect("state/descriptions.sqlite3")
-cursor = conn.execute("SELECT full_id,cbor FROM descriptions")
-descriptions = {d[0]: cbor.loads(d[1]) for d in cursor.fetchall()}
+cursor = conn.execute("SELECT full_id,codec,body FROM description_ids "
+                      "JOIN description_bodies ON description_ids.digest=description_bodies.digest")
+descriptions = {d[0]: cbor.loads(decompress(d[1], d[2])) for d in cursor.fetchall()}
 print(json.dumps(descriptions, indent=2))
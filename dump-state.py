@@ -16,6 +16,9 @@ import cbor
 import json
 
 conn = sqlite3.connect("state/state.sqlite3")
-cursor = conn.execute("SELECT rid,cbor FROM sessions")
-sessions = {d[0]: cbor.loads(d[1]) for d in cursor.fetchall()}
+sessions = {d[0]: {'pk': d[1], 'containers': [], 'tunnels': [], 'clusters': []}
+            for d in conn.execute("SELECT rid,pk FROM session_users").fetchall()}
+for table in ('containers', 'tunnels', 'clusters'):
+    for rid, binary in conn.execute("SELECT rid,cbor FROM session_" + table).fetchall():
+        sessions[rid][table].append(cbor.loads(binary))
 print(sessions)
@@ -0,0 +1,202 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Container ip addresses, allocated from a bitmap per node subnet"""
+
+# Node n's containers live in 10.n.0.0/16. The bottom /24 is kept for tunnel addresses (10.US.0.THEM) and the top
+# two addresses are avoided, everything else is a bit in an 8KB bytearray. Allocation is next fit: a cursor moves
+# up through the subnet and wraps, so a released address isn't handed out again until the rest of the subnet has
+# been gone through. Free addresses are also counted per 256 address block, so full stretches of the subnet are
+# stepped over without looking at them and an allocation is O(1) amortised even when the subnet is nearly full.
+# The bitmaps are persisted in the model snapshot but not trusted: on loading they are reconciled against the
+# containers actually in the model, since an address allocated for a container that never came up (or that went
+# without the node telling us) would otherwise stay allocated across every restart.
+
+import logging
+from array import array
+
+
+class SubnetAllocator:
+    size = 65536
+    first = 256  # offsets below this are tunnel addresses
+    end = 65533  # misses 255.254 and 255.255
+    block = 256
+    capacity = end - first
+
+    def __init__(self, subnet_id, bitmap=None):
+        self.subnet_id = subnet_id
+        self.bitmap = bytearray(SubnetAllocator.size // 8) if bitmap is None else bytearray(bitmap)
+        for offset in list(range(0, SubnetAllocator.first)) + list(range(SubnetAllocator.end, SubnetAllocator.size)):
+            self.bitmap[offset >> 3] |= 1 << (offset & 7)  # reserved, so never found free
+        self.free = array('H', (SubnetAllocator.block - self._set_in(blk)
+                                for blk in range(SubnetAllocator.size // SubnetAllocator.block)))
+        self.allocated = SubnetAllocator.capacity - sum(self.free)
+        self.cursor = SubnetAllocator.first
+
+    def allocate(self):
+        """Returns the offset of a newly allocated address within the subnet"""
+        if self.allocated == SubnetAllocator.capacity:
+            raise ValueError("There are no free addresses in subnet: " + str(self.subnet_id))
+        blocks = len(self.free)
+        blk = self.cursor // SubnetAllocator.block
+        start = self.cursor
+        for _ in range(blocks + 1):  # +1 because the free address may be in the cursor's block, behind the cursor
+            if self.free[blk] != 0:
+                offset = self._clear_in(blk, start)
+                if offset is not None:
+                    self._set(offset)
+                    self.cursor = offset + 1 if offset + 1 < SubnetAllocator.end else SubnetAllocator.first
+                    return offset
+            blk = (blk + 1) % blocks
+            start = blk * SubnetAllocator.block
+        raise RuntimeError("Allocation counts are inconsistent for subnet: " + str(self.subnet_id))
+
+    def mark(self, offset):
+        """Mark an address that's already in use (i.e. a persisted container) as allocated"""
+        if not self.is_set(offset):
+            self._set(offset)
+
+    def release(self, offset):
+        """Returns False if the address wasn't allocated"""
+        if offset < SubnetAllocator.first or offset >= SubnetAllocator.end or not self.is_set(offset):
+            return False
+        self.bitmap[offset >> 3] &= ~(1 << (offset & 7))
+        self.free[offset // SubnetAllocator.block] += 1
+        self.allocated -= 1
+        return True
+
+    def is_set(self, offset):
+        return self.bitmap[offset >> 3] & (1 << (offset & 7)) != 0
+
+    def counts(self):
+        """Cheap enough for every inspection - from the counters, without looking at the bitmap"""
+        return {'allocated': self.allocated,
+                'free_blocks': sum(1 for free in self.free if free == SubnetAllocator.block)}
+
+    def state(self):
+        # free runs, measured a byte at a time where the byte is all free or all used (the reserved bits end runs)
+        runs = 0
+        largest = 0
+        run = 0
+        for idx, byte in enumerate(self.bitmap):
+            if byte == 0:
+                run += 8
+                continue
+            for bit in range(8):
+                if byte & (1 << bit) == 0:
+                    run += 1
+                elif run != 0:
+                    runs += 1
+                    largest = max(largest, run)
+                    run = 0
+        free = SubnetAllocator.capacity - self.allocated
+        return {'allocated': self.allocated,
+                'capacity': SubnetAllocator.capacity,
+                'occupancy': self.allocated / SubnetAllocator.capacity,
+                'free_runs': runs,
+                'largest_free_run': largest,
+                'fragmentation': 0 if free == 0 else 1 - largest / free}
+
+    def _set(self, offset):
+        self.bitmap[offset >> 3] |= 1 << (offset & 7)
+        self.free[offset // SubnetAllocator.block] -= 1
+        self.allocated += 1
+
+    def _set_in(self, blk):
+        start = blk * SubnetAllocator.block // 8
+        return bin(int.from_bytes(self.bitmap[start:start + SubnetAllocator.block // 8], 'big')).count('1')
+
+    def _clear_in(self, blk, start):
+        # first free offset in the block at or after start
+        end = (blk + 1) * SubnetAllocator.block
+        offset = start
+        while offset < end:
+            byte = self.bitmap[offset >> 3]
+            if byte == 0xff:
+                offset = (offset | 7) + 1
+                continue
+            if byte & (1 << (offset & 7)) == 0:
+                return offset
+            offset += 1
+        return None
+
+    def __repr__(self):
+        return "<model.addresses.SubnetAllocator object at %x (subnet_id=%d allocated=%d)>" % \
+               (id(self), self.subnet_id, self.allocated)
+
+
+class IpAllocations:
+    """Allocations across all the subnets, addresses are dotted strings as the nodes use"""
+    def __init__(self, bitmaps=()):
+        self.subnets = {subnet_id: SubnetAllocator(subnet_id, bitmap) for subnet_id, bitmap in bitmaps}
+
+    def allocate(self, subnet_id):
+        offset = self._subnet(subnet_id).allocate()
+        return "10.%d.%d.%d" % (subnet_id, offset // 256, offset % 256)
+
+    def mark(self, ip):
+        try:
+            subnet_id, offset = IpAllocations._parse(ip)
+        except (ValueError, AttributeError):
+            logging.warning("Can't mark as allocated, not a container address: " + str(ip))
+            return
+        self._subnet(subnet_id).mark(offset)
+
+    def release(self, ip):
+        """Returns False if the address wasn't allocated"""
+        try:
+            subnet_id, offset = IpAllocations._parse(ip)
+            return self.subnets[subnet_id].release(offset)
+        except (ValueError, KeyError):
+            return False
+
+    def reconcile(self, ips):
+        """Rebuild from the addresses actually in use, returns how many were allocated but not in use"""
+        persisted = self.subnets
+        self.subnets = {subnet_id: SubnetAllocator(subnet_id) for subnet_id in persisted}
+        for ip in ips:
+            self.mark(ip)
+        leaked = 0
+        for subnet_id, subnet in persisted.items():
+            in_use = int.from_bytes(self.subnets[subnet_id].bitmap, 'little')
+            leaked += bin(int.from_bytes(subnet.bitmap, 'little') & ~in_use).count('1')
+        return leaked
+
+    def bitmaps(self):
+        """For persisting - copies, so can be handed to another thread"""
+        return [[subnet_id, bytes(subnet.bitmap)] for subnet_id, subnet in self.subnets.items()]
+
+    def counts(self):
+        return {str(subnet_id): subnet.counts() for subnet_id, subnet in self.subnets.items()}
+
+    def state(self):
+        return {str(subnet_id): subnet.state() for subnet_id, subnet in self.subnets.items()}
+
+    def __len__(self):
+        return sum(subnet.allocated for subnet in self.subnets.values())
+
+    def _subnet(self, subnet_id):
+        if subnet_id not in self.subnets:
+            self.subnets[subnet_id] = SubnetAllocator(subnet_id)
+            logging.debug("Created allocation bitmap for subnet: " + str(subnet_id))
+        return self.subnets[subnet_id]
+
+    @staticmethod
+    def _parse(ip):
+        # subnet id and offset from a dotted string
+        ten, subnet_id, high, low = (int(part) for part in ip.split('.'))
+        if ten != 10:
+            raise ValueError("Not a container address: " + ip)
+        return subnet_id, high * 256 + low
+
+    def __repr__(self):
+        return "<model.addresses.IpAllocations object at %x (subnets=%d)>" % (id(self), len(self.subnets))
@@ -0,0 +1,182 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Content addressed image descriptions, with a size bounded LRU in front of the database"""
+
+# The same public image pulled by a hundred users has the same description a hundred times, so bodies are stored
+# once each, keyed by the sha256 of their cbor encoding, and (user, image_id) maps onto a digest:
+#   description_ids (full_id -> digest) and description_bodies (digest -> codec, body)
+# Bodies are deflated against a preset dictionary of the strings docker puts in every image description (codec 1),
+# or stored as they are if that doesn't make them smaller (codec 0). Changing the dictionary means a new codec.
+# A body is deleted once the last full_id mapping onto it has moved to something else.
+# Clients can keep the digest and pass it back, then nothing is sent (or written) if it still matches.
+#
+# Nothing is loaded at startup: ids and bodies are read on a miss and kept in two LRU's, the bodies until
+# 'max_bytes' of them (measured as their cbor encoding) are held, the ids up to 'max_ids'. The tables are the
+# authority; a dropped entry is simply read again next time. Something that was just written may not be committed
+# yet, but is in the cache so won't be missed.
+
+import cbor
+import hashlib
+import logging
+import zlib
+from collections import OrderedDict
+
+init_descriptions = """
+CREATE TABLE IF NOT EXISTS description_bodies (digest BLOB NOT NULL PRIMARY KEY, codec INTEGER NOT NULL,
+                                               body BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS description_ids (full_id TEXT NOT NULL PRIMARY KEY, digest BLOB NOT NULL);
+CREATE INDEX IF NOT EXISTS description_ids_digest ON description_ids (digest);
+"""
+
+# common substrings go at the end, they're cheaper to reference from there
+zlib_dictionary = b''.join(s.encode() for s in (
+    'ContainerConfig', 'DockerVersion', 'Author', 'Comment', 'Parent', 'Container', 'VirtualSize', 'Size',
+    'GraphDriver', 'overlay2', 'LowerDir', 'MergedDir', 'UpperDir', 'WorkDir', '/var/lib/docker/overlay2/', '/diff',
+    'Metadata', 'LastTagTime', 'RepoTags', 'RepoDigests', 'latest', '@sha256:', 'Architecture', 'amd64', 'Os',
+    'linux', 'Hostname', 'Domainname', 'User', 'AttachStdin', 'AttachStdout', 'AttachStderr', 'Tty', 'OpenStdin',
+    'StdinOnce', 'ArgsEscaped', 'OnBuild', 'StopSignal', 'SIGTERM', 'Healthcheck', 'Labels', 'maintainer', 'Volumes',
+    'WorkingDir', 'ExposedPorts', '/tcp', 'Entrypoint', 'docker-entrypoint.sh', 'Cmd', '/bin/sh', '-c',
+    '#(nop) ', 'CMD ', 'Image', 'Env', 'PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin',
+    'Created', 'Config', 'Id', 'RootFS', 'Type', 'layers', 'Layers', 'sha256:'))
+
+
+def digest_of(binary):
+    return hashlib.sha256(binary).digest()
+
+
+def compress(binary):
+    """(codec, body) for a cbor encoded description"""
+    deflate = zlib.compressobj(9, zdict=zlib_dictionary)
+    body = deflate.compress(binary) + deflate.flush()
+    if len(body) >= len(binary):
+        return 0, binary
+    return 1, body
+
+
+def decompress(codec, body):
+    if codec == 0:
+        return body
+    if codec == 1:
+        inflate = zlib.decompressobj(zdict=zlib_dictionary)
+        return inflate.decompress(body) + inflate.flush()
+    raise ValueError("Unknown description codec: " + str(codec))
+
+
+class DescriptionCache:
+    def __init__(self, db, *, max_bytes=16*1024*1024, max_ids=65536):
+        self.db = db
+        self.max_bytes = max_bytes
+        self.max_ids = max_ids
+        self.ids = OrderedDict()  # full_id -> digest, least recently used first
+        self.bodies = OrderedDict()  # digest -> (description, size), least recently used first
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.not_modified = 0  # times a client's digest saved us sending or storing a description
+
+    def get(self, full_id):
+        """The description for full_id, or None if there isn't one"""
+        hit = full_id in self.ids and self.ids[full_id] in self.bodies
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+        digest = self.digest(full_id)
+        if digest is None:
+            return None
+        try:
+            desc, size = self.bodies[digest]
+            self.bodies.move_to_end(digest)
+            return desc
+        except KeyError:
+            pass
+        try:
+            codec, body = self.db.query_one("SELECT codec,body FROM description_bodies WHERE digest=?", (digest, ))
+        except ValueError:
+            logging.warning("No description body for: " + full_id)
+            return None
+        binary = decompress(codec, body)
+        desc = cbor.loads(binary)
+        self._insert_body(digest, desc, len(binary))
+        return desc
+
+    def digest(self, full_id):
+        """The digest of the description for full_id, or None if there isn't one"""
+        try:
+            digest = self.ids[full_id]
+            self.ids.move_to_end(full_id)
+            return digest
+        except KeyError:
+            pass
+        try:
+            digest = self.db.query_one("SELECT digest FROM description_ids WHERE full_id=?", (full_id, ))[0]
+        except ValueError:
+            return None
+        self._insert_id(full_id, digest)
+        return digest
+
+    def unchanged(self, full_id, digest):
+        """Is digest (from a client) the digest of the description we have for full_id"""
+        if digest is None or digest != self.digest(full_id):
+            return False
+        self.not_modified += 1
+        return True
+
+    def put(self, full_id, desc, digest=None):
+        """Cache and persist a description, does nothing if it's the one we already have"""
+        if self.unchanged(full_id, digest):
+            return  # without encoding or hashing it
+        binary = cbor.dumps(desc)
+        digest = digest_of(binary)
+        previous = self.digest(full_id)
+        if previous == digest:
+            return
+        self._insert_id(full_id, digest)
+        self._insert_body(digest, desc, len(binary))
+
+        # the body may well be there already (another user, same image) in which case it's ignored
+        codec, body = compress(binary)
+        self.db.mutate("INSERT OR IGNORE INTO description_bodies (digest, codec, body) VALUES (?, ?, ?)",
+                       (digest, codec, body))
+        self.db.mutate("INSERT OR REPLACE INTO description_ids (full_id, digest) VALUES (?, ?)", (full_id, digest))
+        if previous is not None:
+            self.db.mutate("DELETE FROM description_bodies WHERE digest=? AND "
+                           "NOT EXISTS (SELECT 1 FROM description_ids WHERE digest=?)", (previous, previous))
+
+    def state(self):
+        return {'ids': len(self.ids), 'bodies': len(self.bodies), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'not_modified': self.not_modified}
+
+    def _insert_id(self, full_id, digest):
+        self.ids[full_id] = digest
+        self.ids.move_to_end(full_id)
+        while len(self.ids) > self.max_ids:
+            self.ids.popitem(last=False)
+
+    def _insert_body(self, digest, desc, size):
+        if digest in self.bodies:
+            self.bodies.move_to_end(digest)
+            return
+        self.bodies[digest] = (desc, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes and len(self.bodies) > 1:
+            evicted, (_, evicted_size) = self.bodies.popitem(last=False)
+            self.bytes -= evicted_size
+            self.evictions += 1
+            logging.debug("Evicted description from the cache: " + evicted.hex())
+
+    def __repr__(self):
+        return "<model.descriptions.DescriptionCache object at %x (ids=%d bodies=%d bytes=%d)>" % \
+               (id(self), len(self.ids), len(self.bodies), self.bytes)
@@ -17,6 +17,8 @@ from base64 import b64encode
 
 class Domain:
     """A domain claimed or in the process of being claimed by a user"""
+    timeout = 21600  # seconds to complete a claim before it's shed
+
     def __init__(self, domain, token, user, attempted=None, gbl=False):
         self.domain = domain
         self.token = token
@@ -30,11 +32,14 @@ class Domain:
     def is_valid(self):
         return self.token is None
 
+    def expires(self):
+        return self.attempted + Domain.timeout
+
     def timed_out(self):
         if self.is_valid():
             return False
         # if more than six hours since we started attempting to claim the domain
-        return (time.time() - self.attempted) > 21600
+        return time.time() > self.expires()
 
     def mark_as_global(self, gbl=True):
         self.gbl = gbl
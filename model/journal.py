@@ -0,0 +1,218 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""An append-only journal of committed batches, shipped asynchronously to the shared state mount"""
+
+# Used so the live databases can sit on local disk rather than EFS. Each batch the WriteBehindCache commits is
+# first appended to a local journal as [seq, [[sql, params], ...]] (cbor, length prefixed) and the database's
+# user_version is set to seq in the same transaction, so the database always knows how much of the journal it holds.
+# A replication thread copies the journal to the shared mount. Once the journal gets large the database is
+# checkpointed: backed up to the shared mount, and both journals truncated.
+#
+# On startup (restore) the local database, if there is one, is brought up to date from the local journal. If there
+# isn't, or the shared copy has got further than it (the broker ran on another machine for a while and has come
+# back), the shared snapshot and journal are copied in and replayed instead. How far a copy has got is the highest
+# sequence number in either its database (user_version) or its journal.
+# Replication is asynchronous: if the machine itself is lost so is anything that hadn't been shipped yet,
+# typically the last 'interval' seconds.
+
+import cbor
+import logging
+import os
+import shutil
+import sqlite3
+import struct
+from threading import Thread, Event, Lock
+from model.store import apply_batch
+
+
+class Journal:
+    def __init__(self, local_directory, shared_directory, name, *, interval=1, checkpoint_bytes=16*1024*1024):
+        self.name = name
+        self.local_filename = local_directory + "/" + name + ".journal"
+        self.shared_filename = shared_directory + "/" + name + ".journal"
+        self.shared_snapshot = shared_directory + "/" + name + ".sqlite3"
+        self.interval = interval
+        self.checkpoint_bytes = checkpoint_bytes
+        self.seq = 0  # last sequence number appended (or replayed)
+        self.shipped = 0  # bytes of the local journal that are on the shared mount
+        self.local = None
+        self.lock = Lock()  # held while shipping or checkpointing
+        self.wake = Event()
+        self.stopping = False
+        self.thread = None
+
+    def restore(self, db_filename):
+        """Bring the local database up to date, call before opening it"""
+        if not os.path.exists(db_filename):
+            reason = "there is no local copy"  # a new machine, or a lost disk
+        else:
+            local_seq = max(Journal._user_version(db_filename), self._last_seq(self.local_filename))
+            shared_seq = max(Journal._user_version(self.shared_snapshot), self._last_seq(self.shared_filename))
+            reason = "the shared copy is newer (%d > %d)" % (shared_seq, local_seq) if shared_seq > local_seq else None
+        if reason is not None:
+            for local, shared in ((db_filename, self.shared_snapshot), (self.local_filename, self.shared_filename)):
+                if os.path.exists(shared):
+                    shutil.copyfile(shared, local)
+                elif os.path.exists(local):
+                    os.remove(local)
+            logging.info("Restoring %s from the shared state mount, %s" % (self.name, reason))
+
+        # replay
+        db = sqlite3.connect(db_filename, isolation_level=None)
+        self.seq = db.execute("PRAGMA user_version").fetchone()[0]
+        replayed = 0
+        for seq, batch in self._records():
+            if seq > self.seq:
+                db.execute("BEGIN")
+                apply_batch(db, self.name, batch)
+                db.execute("PRAGMA user_version=%d" % seq)
+                db.execute("COMMIT")
+                replayed += 1
+            self.seq = max(self.seq, seq)
+        db.close()
+        if replayed != 0:
+            logging.info("Replayed %d batch(es) from the journal for: %s" % (replayed, self.name))
+
+        # ship from wherever the shared copy got to
+        self.local = open(self.local_filename, 'ab')
+        local_size = self.local.tell()
+        shared_size = os.path.getsize(self.shared_filename) if os.path.exists(self.shared_filename) else 0
+        if shared_size > local_size:
+            logging.warning("Shared journal is longer than the local one, replacing it: " + self.name)
+            os.remove(self.shared_filename)
+            shared_size = 0
+        self.shipped = shared_size
+
+    def start(self):
+        self.thread = Thread(target=self._replicate, name='journal-' + self.name)
+        self.thread.start()
+
+    def stop(self, rw_sql=None):
+        """Ship everything and stop, checkpoints first if passed the writer's connection"""
+        if rw_sql is not None:
+            self.checkpoint(rw_sql)
+        self.stopping = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        try:
+            self._ship()  # in case the thread was already part way through its last pass
+        except OSError as e:
+            logging.error("Failed shipping the end of the journal for %s: %s" % (self.name, str(e)))
+        self.local.close()
+
+    def next_seq(self):
+        self.seq += 1
+        return self.seq
+
+    def append(self, seq, batch):
+        """Write a batch to the local journal - before it's committed"""
+        record = cbor.dumps([seq, [[sql, list(params)] for sql, params in batch]])
+        self.local.write(struct.pack('>I', len(record)) + record)
+        self.local.flush()
+        os.fsync(self.local.fileno())
+        self.wake.set()
+
+    def needs_checkpoint(self):
+        return self.local.tell() > self.checkpoint_bytes
+
+    def checkpoint(self, rw_sql):
+        """Snapshot the database to the shared mount and start both journals again - call from the writer thread"""
+        with self.lock:
+            tmp = self.shared_snapshot + '.tmp'
+            snapshot = sqlite3.connect(tmp)
+            rw_sql.backup(snapshot)
+            snapshot.close()
+            os.replace(tmp, self.shared_snapshot)
+
+            # everything in the journals is in the snapshot now (and replay would skip it anyway)
+            open(self.shared_filename, 'wb').close()
+            self.local.truncate(0)
+            self.local.seek(0)
+            self.shipped = 0
+        logging.info("Checkpointed %s to the shared state mount at: %d" % (self.name, self.seq))
+
+    def _replicate(self):
+        while not self.stopping:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            try:
+                self._ship()
+            except OSError as e:
+                logging.warning("Failed shipping the journal for %s (will retry): %s" % (self.name, str(e)))
+
+    def _ship(self):
+        with self.lock:
+            with open(self.local_filename, 'rb') as src:
+                src.seek(self.shipped)
+                data = src.read()
+            if len(data) == 0:
+                return
+            with open(self.shared_filename, 'ab') as dst:
+                if dst.tell() != self.shipped:  # someone has been fiddling, start the shared copy again
+                    dst.truncate(0)
+                    self.shipped = 0
+                    with open(self.local_filename, 'rb') as src:
+                        data = src.read()
+                dst.write(data)
+                dst.flush()
+                os.fsync(dst.fileno())
+            self.shipped += len(data)
+
+    def _last_seq(self, filename):
+        seq = 0
+        for seq, batch in self._records(filename):
+            pass
+        return seq
+
+    def _records(self, filename=None):
+        # (seq, batch) from a journal, the local one by default - truncating any torn record on the end of that
+        filename = self.local_filename if filename is None else filename
+        if not os.path.exists(filename):
+            return
+        local = filename == self.local_filename
+        with open(filename, 'r+b' if local else 'rb') as f:
+            good = 0
+            while True:
+                header = f.read(4)
+                if len(header) < 4:
+                    break
+                length = struct.unpack('>I', header)[0]
+                record = f.read(length)
+                if len(record) < length:
+                    break
+                try:
+                    seq, batch = cbor.loads(record)
+                except BaseException:
+                    break
+                good = f.tell()
+                yield seq, batch
+            if local and good != os.path.getsize(filename):
+                logging.warning("Truncating a torn record from the end of the journal: " + self.name)
+                f.truncate(good)
+
+    @staticmethod
+    def _user_version(db_filename):
+        # straight from the header, so without opening (or locking) the database
+        try:
+            with open(db_filename, 'rb') as f:
+                f.seek(60)
+                header = f.read(4)
+        except FileNotFoundError:
+            return 0
+        return struct.unpack('>I', header)[0] if len(header) == 4 else 0
+
+    def __repr__(self):
+        return "<model.journal.Journal object at %x (%s seq=%d shipped=%d)>" % \
+               (id(self), self.name, self.seq, self.shipped)
+
@@ -16,12 +16,19 @@
 
 
 import logging
-import random
+import os
+import time
+from heapq import heappush, heappop
+from itertools import count
 import cbor
 from base64 import b64encode
 from tfnz import TaggedCollection
 from controller.network import Network
-from litecache.cache import SqlCache
+from model.store import WriteBehindCache
+from model.journal import Journal
+from model.addresses import IpAllocations
+from model.offers import Offers
+from model.descriptions import DescriptionCache, init_descriptions, digest_of, compress
 from messidge.broker.bases import ModelMinimal
 from model.session import Session
 from model.domain import Domain
@@ -31,63 +38,241 @@ init_domains = """
 CREATE TABLE domains (domain TEXT NOT NULL UNIQUE, token TEXT, attempted INTEGER, user TEXT, global BOOLEAN DEFAULT 0);
 """
 
-init_descriptions = """
-CREATE TABLE descriptions (full_id TEXT NOT NULL UNIQUE, cbor BLOB NOT NULL);
+# sessions are persisted a row per container, tunnel and cluster so a change only writes the row that changed
+init_session_rows = """
+CREATE TABLE IF NOT EXISTS session_users (rid BLOB NOT NULL PRIMARY KEY, pk BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS session_containers (uuid BLOB NOT NULL PRIMARY KEY, rid BLOB NOT NULL, cbor BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS session_tunnels (uuid BLOB NOT NULL PRIMARY KEY, rid BLOB NOT NULL, cbor BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS session_clusters (uuid BLOB NOT NULL PRIMARY KEY, rid BLOB NOT NULL, cbor BLOB NOT NULL);
 """
 
 init_state = """
-CREATE TABLE sessions (rid TEXT NOT NULL PRIMARY KEY, cbor BLOB NOT NULL);
 CREATE TABLE forwarding (key BLOB NOT NULL PRIMARY KEY, value BLOB NOT NULL);
-"""
+""" + init_session_rows
+
+session_row_tables = ('session_containers', 'session_tunnels', 'session_clusters')
+
+
+class Sessions(dict):
+    """rid -> session, that also keeps track of which sessions belong to which user"""
+    # messidge adds, removes and re-keys (on recovery) sessions by assigning into model.sessions, so the index
+    # has to be maintained here rather than by calling methods on the model.
+    def __init__(self, initial=None):
+        super().__init__()
+        self.by_user = {}  # user pk -> {rid: session}
+        if initial is not None:
+            for rid, sess in initial.items():
+                self[rid] = sess
+
+    def __setitem__(self, rid, sess):
+        if rid in self:
+            self._unindex(rid, super().__getitem__(rid))
+        super().__setitem__(rid, sess)
+        if sess.pk not in self.by_user:
+            self.by_user[sess.pk] = {}
+        self.by_user[sess.pk][rid] = sess
+
+    def __delitem__(self, rid):
+        self._unindex(rid, super().__getitem__(rid))
+        super().__delitem__(rid)
+
+    def pop(self, rid, *default):
+        if rid in self:
+            self._unindex(rid, super().__getitem__(rid))
+        return super().pop(rid, *default)
+
+    def for_user(self, pk):
+        return list(self.by_user.get(pk, {}).values())
+
+    def _unindex(self, rid, sess):
+        try:
+            user_sessions = self.by_user[sess.pk]
+            del user_sessions[rid]
+            if len(user_sessions) == 0:
+                del self.by_user[sess.pk]
+        except KeyError:
+            pass
 
 
 class Model(ModelMinimal):
-    def __init__(self, state_directory):
+    snapshot_version = 3
+
+    def __init__(self, state_directory, local_directory=None):
         super().__init__()
-        # db's up and going
-        self.state_db = SqlCache(state_directory, 'state', init_state)
-        self.domains_db = SqlCache(state_directory, 'domains', init_domains)
-        self.descriptions_db = SqlCache(state_directory, 'descriptions', init_descriptions)
+        # db's up and going - on local disk journalled back to the state directory if a local directory is passed
+        if local_directory is not None:
+            os.makedirs(local_directory, exist_ok=True)
+        self.state_db = Model._open_db(state_directory, local_directory, 'state', init_state)
+        self.domains_db = Model._open_db(state_directory, local_directory, 'domains', init_domains)
+        self.descriptions_db = Model._open_db(state_directory, local_directory, 'descriptions', init_descriptions)
+
+        # the whole model in one file so a restart doesn't have to rebuild it from the databases
+        self.snapshot_filename = (local_directory if local_directory is not None else state_directory) + \
+            '/model.snapshot'
+        self._migrate_session_blobs()
+        self._migrate_description_blobs()
+        state = self._read_snapshot()
+        self.volumes_verified = state is None  # a snapshot's volumes get checked against zfs by verify_volumes
+        self.unverified_removals = set()  # uuids of volumes destroyed while the check was running
+        if state is None:
+            state = self._read_databases()
+
+        # resource offers, stamped as the model changes
+        self.offers = Offers()
 
         # initialise sessions, containers and ip allocations
-        binary_sessions = self.state_db.query("SELECT rid,cbor FROM sessions")
-        self.sessions = {rid: Session.from_binary(rid, binary) for rid, binary in binary_sessions}
+        self.sessions = Sessions({rid: Session.from_rows(rid, pk, containers, tunnels, clusters)
+                                  for rid, pk, containers, tunnels, clusters in state['sessions']})
         self.containers = TaggedCollection()
-        self.allocations = set()
+        self.node_containers = {}  # node_pk -> {uuid: container}, so losing a node only touches its own
+        self.user_externals = {}  # user pk -> {uuid: container} for tagged containers only
+        self.volume_containers = {}  # volume uuid -> {uuid: container} mounting that volume
+        self.fqdn_clusters = {}  # fqdn -> cluster
+        self.allocations = IpAllocations(state.get('allocations', ()))  # only a snapshot has the bitmaps
+        in_use = []
         for session in self.sessions.values():
             for uuid, container in session.dependent_containers.items():
-                self.containers.add(container)
-                self.allocations.add(container.ip)
-
-        # fetch the forwarding table
-        forwarding = self.state_db.query("SELECT key,value FROM forwarding")
-        for forward in forwarding:
-            self.long_term_forwards[forward[0]] = forward[1]
+                self.add_container(container)
+                in_use.append(container.ip)
+            for cluster in session.clusters.values():
+                self.add_cluster(cluster)
+        leaked = self.allocations.reconcile(in_use)
+        if leaked != 0:
+            logging.warning("Released %d ip(s) allocated to containers that are no longer in the model" % leaked)
+
+        # the forwarding table
+        for key, value in state['forwarding']:
+            self.long_term_forwards[key] = value
 
         # volumes
-        self.volumes = Volume.all()
+        self.volumes = TaggedCollection()
+        self.user_volumes = {}  # user pk -> {uuid: volume}
+        for user, uuid, tag in state['volumes']:
+            self.add_volume(Volume(user, uuid, tag))
 
         # domain ownership
         self.domains = {}
         self.global_domains = {}
-        domains = self.domains_db.query("SELECT domain,token,attempted,user,global FROM domains")
-        for domain, token, attempted, user, gbl in domains:
+        self.claimed_domains = {}  # domain name -> domain, whoever has it and whether or not the claim is complete
+        self.pending_domains = []  # heap of (expires, n, domain) for claims that haven't completed
+        self.pending_count = count()  # tie breaker so the heap never compares domain objects
+        for domain, token, attempted, user, gbl in state['domains']:
             dom_obj = Domain(domain, token, user, attempted, gbl)
-            if user not in self.domains:
-                self.domains[user] = {}  # map domain name to domain object
-            self.domains[user][domain] = dom_obj
+            self.add_domain(dom_obj)
             if gbl:
                 self.global_domains[domain] = dom_obj
 
-        # descriptions
-        descriptions = self.descriptions_db.query("SELECT full_id,cbor FROM descriptions")
-        self.descriptions = {d[0]: cbor.loads(d[1]) for d in descriptions}
+        # descriptions, loaded as they're asked for
+        self.descriptions = DescriptionCache(self.descriptions_db)
 
     def close(self):
+        try:
+            self.write_snapshot(self.snapshot())
+        except BaseException as e:
+            logging.error("Failed writing the model snapshot: " + str(e))
         [db.close() for db in (self.descriptions_db, self.domains_db, self.state_db)]
 
+    def snapshot(self):
+        """Everything needed to reconstruct the model, call from the loop then pass to write_snapshot"""
+        # the change counters are those after everything queued so far has been committed, which write_snapshot
+        # waits for - so the loop doesn't have to
+        return {'version': Model.snapshot_version,
+                'counters': [db.mark() for db in (self.state_db, self.domains_db)],
+                'sessions': [[sess.rid, sess.pk,
+                              [c.as_dict() for c in sess.dependent_containers.values()],
+                              [t.as_dict() for t in sess.tunnels.values()],
+                              [c.as_dict() for c in sess.clusters.values()]] for sess in self.sessions.values()],
+                'forwarding': [[key, value] for key, value in self.long_term_forwards.items()],
+                'volumes': [[vol.user, vol.uuid, vol.tag] for vol in self.volumes.values()],
+                'domains': [[dom.domain, dom.token, dom.attempted, dom.user, dom.gbl]
+                            for user_domains in self.domains.values() for dom in user_domains.values()],
+                'allocations': self.allocations.bitmaps()}
+
+    def write_snapshot(self, state):
+        """Can be called from a worker thread"""
+        state = dict(state, counters=[mark.counter() for mark in state['counters']])
+        tmp = self.snapshot_filename + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(cbor.dumps(state))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.snapshot_filename)
+        logging.info("Wrote model snapshot: %d sessions" % len(state['sessions']))
+
+    def verify_volumes(self, found, exception):
+        """Reconcile volumes loaded from a snapshot with those zfs actually has (from Volume.all)"""
+        if exception is not None:
+            logging.error("Could not verify volumes against zfs: " + str(exception))
+            return
+        for vol in found.values():
+            if vol.uuid in self.unverified_removals:
+                continue  # zfs listed it before the job destroying it ran
+            if vol.uuid not in self.volumes:
+                logging.warning("Volume was missing from the snapshot: " + vol.uuid.decode())
+                self.add_volume(vol)
+        for vol in self.volumes.values():
+            if vol.uuid not in found:
+                logging.warning("Volume in the snapshot no longer exists: " + vol.uuid.decode())
+                self.remove_volume(vol)
+        self.volumes_verified = True
+        self.unverified_removals.clear()
+
+    def add_container(self, ctr):
+        self.containers.add(ctr)
+        Model._index(self.node_containers, ctr.node_pk, ctr.uuid, ctr)
+        if ctr.tag is not None:
+            Model._index(self.user_externals, ctr.user, ctr.uuid, ctr)
+            self.offers.changed('externals', ctr.user)
+        for volume in ctr.volumes:
+            Model._index(self.volume_containers, volume, ctr.uuid, ctr)
+
+    def remove_container(self, ctr):
+        try:
+            self.containers.remove(ctr)
+        except KeyError:
+            logging.debug("Tried to remove a container that was not in the model: " + ctr.uuid.decode())
+        Model._unindex(self.node_containers, ctr.node_pk, ctr.uuid)
+        if ctr.tag is not None:
+            Model._unindex(self.user_externals, ctr.user, ctr.uuid)
+            self.offers.changed('externals', ctr.user)
+        for volume in ctr.volumes:
+            Model._unindex(self.volume_containers, volume, ctr.uuid)
+
+    def containers_on_node(self, node_pk):
+        return list(self.node_containers.get(node_pk, {}).values())
+
+    def containers_mounting(self, volume_uuid):
+        return list(self.volume_containers.get(volume_uuid, {}).values())
+
+    def add_volume(self, vol):
+        self.unverified_removals.discard(vol.uuid)  # a destroy that failed
+        self.volumes.add(vol)
+        Model._index(self.user_volumes, vol.user, vol.uuid, vol)
+        self.offers.changed('volumes', vol.user)
+
+    def remove_volume(self, vol):
+        if not self.volumes_verified:
+            self.unverified_removals.add(vol.uuid)
+        self.volumes.remove(vol)
+        Model._unindex(self.user_volumes, vol.user, vol.uuid)
+        self.offers.changed('volumes', vol.user)
+
+    def add_cluster(self, cluster):
+        # An occasion may arise where the same cluster is registered twice (swapping over), the first one wins
+        if cluster.fqdn() in self.fqdn_clusters:
+            logging.debug("Avoided indexing two clusters for: " + cluster.fqdn())
+            return
+        self.fqdn_clusters[cluster.fqdn()] = cluster
+
+    def remove_cluster(self, cluster):
+        if self.fqdn_clusters.get(cluster.fqdn()) is cluster:
+            del self.fqdn_clusters[cluster.fqdn()]
+
+    def cluster_for_fqdn(self, fqdn):
+        return self.fqdn_clusters.get(fqdn)
+
     def sessions_for_user(self, pk):
-        return [s.rid for s in self.sessions.values() if s.pk == pk]
+        return [s.rid for s in self.sessions.for_user(pk)]
 
     def all_tunnels(self):
         rtn = []
@@ -96,17 +281,7 @@ class Model(ModelMinimal):
         return rtn
 
     def all_clusters(self):
-        # An occasion may arise where the same cluster is registered twice (swapping over) hence we check for this
-        clusters = []
-        done_already = set()
-        for sess in self.sessions.values():
-            for cluster in sess.clusters.values():
-                if cluster.fqdn() in done_already:
-                    logging.debug("Avoided creating two records for a cluster in all_clusters: " + cluster.fqdn())
-                else:
-                    clusters.append(cluster)
-                    done_already.add(cluster.fqdn())
-        return clusters
+        return list(self.fqdn_clusters.values())
 
     def network_topology(self):
         """Returns a list of (subnet_id, external_ip) tuples"""
@@ -115,36 +290,57 @@ class Model(ModelMinimal):
         return topo
 
     def next_ip(self, node_id):
-        smallest = node_id * 65536 + 256  # so the bottom /8 can be used for tunnel addresses i.e. 10.US.0.THEM
-        biggest = smallest + 65277  # short enough to miss 255.255 and 255.254
-        ip = None
-        while ip is None or ip in self.allocations:
-            ip = Model.ip_from_int(random.randrange(smallest, biggest))
-        self.allocations.add(ip)
+        ip = self.allocations.allocate(node_id)
         logging.info("Allocated ip: " + ip)
         return ip
 
     def release_ip(self, ip):
-        try:
-            self.allocations.remove(ip)
+        if ip is not None and self.allocations.release(ip):
             logging.info("Released ip: " + ip)
-        except KeyError:
+        else:
             logging.debug("Tried to delete an ip, not apparently in table: " + ("None" if ip is None else ip))
 
+    def add_domain(self, dom):
+        """A domain being prepared (or loaded), raises ValueError if someone else has it"""
+        current = self.claimed_domains.get(dom.domain)
+        if current is not None and current is not dom:
+            if not current.timed_out():
+                raise ValueError('This domain is already claimed or in the process of being claimed')
+            self.remove_domain(current)  # expired but not shed yet
+            self.delete_domain_record(current.domain)
+        if dom.user not in self.domains:
+            self.domains[dom.user] = {}  # map domain name to domain object
+        self.domains[dom.user][dom.domain] = dom
+        self.claimed_domains[dom.domain] = dom
+        self.offers.changed('domains', dom.user)
+        if not dom.is_valid():
+            heappush(self.pending_domains, (dom.expires(), next(self.pending_count), dom))
+
+    def remove_domain(self, dom):
+        # any entry in the heap is left to be discarded when it comes to the top
+        self.domains.get(dom.user, {}).pop(dom.domain, None)
+        if self.claimed_domains.get(dom.domain) is dom:
+            del self.claimed_domains[dom.domain]
+        if self.global_domains.get(dom.domain) is dom:
+            del self.global_domains[dom.domain]
+            self.offers.changed('domains')
+        self.offers.changed('domains', dom.user)
+
     def shed_aged_domains(self):
-        # removes aged domains for all users (SLOW)
-        for pk in self.domains.keys():
-            self.shed_aged_domains_for(pk)
-
-    def shed_aged_domains_for(self, pk):
-        # removes domains that are more than 2 hours after their 'attempted' time for this user
-        if pk not in self.domains:
-            self.domains[pk] = {}
-        for dom in list(self.domains[pk].values()):
-            if dom.timed_out():
-                logging.info("Domain removed due to timeout: " + str(dom.domain))
-                del self.domains[pk][dom.domain]
-                self.domains_db.mutate("DELETE FROM domains WHERE domain=?;", (dom.domain,))
+        """Removes claims that weren't completed in time - O(expired log n), call from a timer"""
+        now = time.time()
+        shed = []
+        while len(self.pending_domains) != 0 and self.pending_domains[0][0] < now:
+            expires, n, dom = heappop(self.pending_domains)
+            if dom.is_valid() or self.claimed_domains.get(dom.domain) is not dom:
+                continue  # completed or released since
+            logging.info("Domain removed due to timeout: " + str(dom.domain))
+            self.remove_domain(dom)
+            shed.append(dom.domain)
+        for start in range(0, len(shed), 500):  # sqlite has a limit on the number of parameters
+            chunk = shed[start:start + 500]
+            self.domains_db.mutate("DELETE FROM domains WHERE domain IN (%s)" % ','.join('?' * len(chunk)), chunk)
+        return len(shed)
 
     def domain_list(self):
         rtn = []
@@ -157,30 +353,155 @@ class Model(ModelMinimal):
             logging.warning("Tried to add a global domain but it was added already.")
             return
         self.global_domains[dom.domain] = dom
+        self.offers.changed('domains')
 
     def remove_global_domain(self, dom):
         if dom.domain not in self.global_domains:
             logging.warning("Tried to remove a global domain but it wasn't there.")
             return
         del self.global_domains[dom.domain]
+        self.offers.changed('domains')
 
-    def create_update_description_record(self, user_pk, image_id, desc):
+    def create_update_description_record(self, user_pk, image_id, desc, digest=None):
         full_id = b64encode(user_pk).decode() + image_id
-        if full_id in self.descriptions and self.descriptions[full_id] == desc:
-            return  # is the one we already had
-
-        self.descriptions[full_id] = desc
-        self.descriptions_db.mutate("INSERT OR REPLACE INTO descriptions (full_id,cbor) VALUES (?, ?)",
-                                   (full_id, cbor.dumps(desc)))
+        self.descriptions.put(full_id, desc, digest)
 
     def create_session_record(self, sess):
-        self.state_db.mutate("INSERT OR REPLACE INTO sessions (rid, cbor) VALUES (?, ?)", (sess.rid, sess.binary()))
+        self.state_db.mutate("INSERT OR REPLACE INTO session_users (rid, pk) VALUES (?, ?)", (sess.rid, sess.pk))
+        for ctr in sess.dependent_containers.values():
+            self.set_container_record(sess, ctr)
+        for tunnel in sess.tunnels.values():
+            self.set_tunnel_record(sess, tunnel)
+        for cluster in sess.clusters.values():
+            self.set_cluster_record(sess, cluster)
 
     def update_session_record(self, sess):
-        self.state_db.mutate("UPDATE sessions SET cbor=? WHERE rid=?", (sess.binary(), sess.rid))
+        # rewrites the whole session, use the individual record methods when you know what changed
+        self.delete_session_record(sess.rid)
+        self.create_session_record(sess)
 
     def delete_session_record(self, rid):
-        self.state_db.mutate("DELETE FROM sessions WHERE rid=?", (rid, ))
+        self.state_db.mutate("DELETE FROM session_users WHERE rid=?", (rid, ))
+        for table in session_row_tables:
+            self.state_db.mutate("DELETE FROM %s WHERE rid=?" % table, (rid, ))
+
+    def set_container_record(self, sess, ctr):
+        self.state_db.mutate("INSERT OR REPLACE INTO session_containers (uuid, rid, cbor) VALUES (?, ?, ?)",
+                             (ctr.uuid, sess.rid, cbor.dumps(ctr.as_dict())))
+
+    def delete_container_records(self, uuids):
+        uuids = list(uuids)
+        for start in range(0, len(uuids), 500):  # sqlite has a limit on the number of parameters
+            chunk = uuids[start:start + 500]
+            self.state_db.mutate("DELETE FROM session_containers WHERE uuid IN (%s)" % ','.join('?' * len(chunk)),
+                                 chunk)
+
+    def set_tunnel_record(self, sess, tunnel):
+        self.state_db.mutate("INSERT OR REPLACE INTO session_tunnels (uuid, rid, cbor) VALUES (?, ?, ?)",
+                             (tunnel.uuid, sess.rid, cbor.dumps(tunnel.as_dict())))
+
+    def delete_tunnel_record(self, uuid):
+        self.state_db.mutate("DELETE FROM session_tunnels WHERE uuid=?", (uuid, ))
+
+    def set_cluster_record(self, sess, cluster):
+        self.state_db.mutate("INSERT OR REPLACE INTO session_clusters (uuid, rid, cbor) VALUES (?, ?, ?)",
+                             (cluster.uuid, sess.rid, cbor.dumps(cluster.as_dict())))
+
+    def delete_cluster_record(self, uuid):
+        self.state_db.mutate("DELETE FROM session_clusters WHERE uuid=?", (uuid, ))
+
+    def _read_snapshot(self):
+        # the snapshot, if there is one and the databases haven't changed since it was taken
+        try:
+            with open(self.snapshot_filename, 'rb') as f:
+                state = cbor.loads(f.read())
+        except FileNotFoundError:
+            return None
+        except BaseException as e:
+            logging.warning("Could not read the model snapshot: " + str(e))
+            return None
+        counters = [db.change_counter() for db in (self.state_db, self.domains_db)]
+        if state.get('version') != Model.snapshot_version or state.get('counters') != counters:
+            logging.info("Model snapshot is out of date, loading from the databases")
+            return None
+        logging.info("Loading the model from its snapshot")
+        return state
+
+    def _read_databases(self):
+        # the same structure as a snapshot
+        users = self.state_db.query("SELECT rid,pk FROM session_users")
+        rows = {rid: ([], [], []) for rid, pk in users}
+        for idx, table in enumerate(session_row_tables):
+            for rid, binary in self.state_db.query("SELECT rid,cbor FROM %s" % table):
+                try:
+                    rows[rid][idx].append(cbor.loads(binary))
+                except KeyError:
+                    logging.warning("Found a persisted row for a session that doesn't exist, in: " + table)
+        return {'sessions': [[rid, pk] + list(rows[rid]) for rid, pk in users],
+                'forwarding': self.state_db.query("SELECT key,value FROM forwarding"),
+                'volumes': [[vol.user, vol.uuid, vol.tag] for vol in Volume.all().values()],
+                'domains': self.domains_db.query("SELECT domain,token,attempted,user,global FROM domains")}
+
+    def _migrate_session_blobs(self):
+        # one time: moves sessions from a cbor blob each to a row per container/tunnel/cluster
+        # goes through mutate so it's journalled, and flushed because it has to be complete before we load anything
+        # if interrupted it just happens again: the inserts replace and the old table is only dropped at the end
+        # nothing is written unless there's something to do, a commit would change the counter a snapshot is checked by
+        tables = Model._tables(self.state_db)
+        if 'sessions' not in tables and tables.issuperset(('session_users', ) + session_row_tables):
+            return
+        for statement in init_session_rows.split(';'):
+            if statement.strip() != '':
+                self.state_db.mutate(statement, ())
+        self.state_db.flush()
+        if 'sessions' not in tables:
+            return
+        blobs = self.state_db.query("SELECT rid,cbor FROM sessions")
+        for rid, binary in blobs:
+            # work on the decoded dicts, constructing clusters has side effects (ssl files)
+            elements = cbor.loads(binary)
+            self.state_db.mutate("INSERT OR REPLACE INTO session_users (rid, pk) VALUES (?, ?)", (rid, elements['pk']))
+            for table, key in zip(session_row_tables, ('containers', 'tunnels', 'clusters')):
+                for element in elements[key]:
+                    self.state_db.mutate("INSERT OR REPLACE INTO %s (uuid, rid, cbor) VALUES (?, ?, ?)" % table,
+                                         (element['uuid'], rid, cbor.dumps(element)))
+        self.state_db.mutate("DROP TABLE sessions", ())
+        self.state_db.flush()
+        logging.info("Migrated %d persisted session(s) to per-row storage" % len(blobs))
+
+    def _migrate_description_blobs(self):
+        # one time: moves descriptions from a cbor blob per user and image to content addressed bodies
+        # as with sessions, journalled and flushed, only written if needed, and if interrupted it just happens again
+        tables = Model._tables(self.descriptions_db)
+        if 'descriptions' not in tables and tables.issuperset(('description_bodies', 'description_ids')):
+            return
+        for statement in init_descriptions.split(';'):
+            if statement.strip() != '':
+                self.descriptions_db.mutate(statement, ())
+        self.descriptions_db.flush()
+        if 'descriptions' not in tables:
+            return
+        blobs = self.descriptions_db.query("SELECT full_id,cbor FROM descriptions")
+        for full_id, binary in blobs:
+            digest = digest_of(binary)
+            self.descriptions_db.mutate("INSERT OR IGNORE INTO description_bodies (digest, codec, body) "
+                                        "VALUES (?, ?, ?)", (digest, ) + compress(binary))
+            self.descriptions_db.mutate("INSERT OR REPLACE INTO description_ids (full_id, digest) VALUES (?, ?)",
+                                        (full_id, digest))
+        self.descriptions_db.mutate("DROP TABLE descriptions", ())
+        self.descriptions_db.flush()
+        logging.info("Migrated %d description(s) to %d content addressed bodies" %
+                     (len(blobs), len(set(digest_of(binary) for full_id, binary in blobs))))
+
+    @staticmethod
+    def _tables(db):
+        return {name for name, in db.query("SELECT name FROM sqlite_master WHERE type='table'")}
+
+    @staticmethod
+    def _open_db(state_directory, local_directory, name, init):
+        if local_directory is None:
+            return WriteBehindCache(state_directory, name, init)
+        return WriteBehindCache(local_directory, name, init, journal=Journal(local_directory, state_directory, name))
 
     def set_forwarding_record(self, key, value):
         self.state_db.mutate("INSERT OR REPLACE INTO forwarding (key, value) VALUES (?, ?)", (key, value))
@@ -193,6 +514,7 @@ class Model(ModelMinimal):
                               (dom.domain, dom.token, dom.attempted, session.pk, False))
 
     def update_domain_record(self, dom):
+        self.offers.changed('domains', dom.user)  # has been validated, or made global or private
         self.domains_db.mutate("UPDATE domains SET token=?, attempted=?, global=? WHERE domain=?",
                               (dom.token, dom.attempted, dom.gbl, dom.domain))
 
@@ -201,19 +523,23 @@ class Model(ModelMinimal):
 
     def resources(self, user_pk):
         """Return a resource offer"""
+        return self.offers.offer(user_pk, self._build_resources)
+
+    def resources_since(self, user_pk, version):
+        """Return the parts of a resource offer that have changed since 'version' (from a previous offer)"""
+        return self.offers.delta(user_pk, version, self._build_resources)
+
+    def _build_resources(self, user_pk):
         # ensure we can reference the user
         if user_pk not in self.domains:
             self.domains[user_pk] = {}  # map domain name to domain object
 
-        # See if any domains have timed out
-        self.shed_aged_domains_for(user_pk)
-
         # Go
         nodes = [(node.pk, node.perf_counters) for node in self.nodes.values()]
         volumes = [{'uuid': vol.uuid, 'tag': vol.tag}
-                   for vol in self.volumes.values() if vol.user == user_pk]
+                   for vol in self.user_volumes.get(user_pk, {}).values()]
         externals = [{'tag': ctr.tag, 'uuid': ctr.uuid, 'ip': ctr.ip, 'node': ctr.node_pk}
-                     for ctr in self.containers.values() if ctr.tag is not None and ctr.user == user_pk]
+                     for ctr in self.user_externals.get(user_pk, {}).values()]
         domains = [{'domain': dom.domain, 'global': dom.is_global()}
                    for dom in self.domains[user_pk].values() if dom.is_valid()]
         domains.extend([{'domain': dom.domain, 'global': dom.is_global()}
@@ -223,8 +549,20 @@ class Model(ModelMinimal):
         return {'nodes': nodes, 'volumes': volumes, 'externals': externals, 'domains': domains}
 
     @staticmethod
-    def ip_from_int(n):
-        return "10.%d.%d.%d" % (n // 65536, (n // 256) % 256, n % 256)
+    def _index(index, key, uuid, obj):
+        if key not in index:
+            index[key] = {}
+        index[key][uuid] = obj
+
+    @staticmethod
+    def _unindex(index, key, uuid):
+        try:
+            entries = index[key]
+            del entries[uuid]
+            if len(entries) == 0:
+                del index[key]
+        except KeyError:
+            pass
 
     def __repr__(self):
         return "<model.model.Model object at %x>" % id(self)
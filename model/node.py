@@ -27,6 +27,7 @@ class Node(NodeMinimal):
         self.subnet_id = config['subnet_id']
         self.external_ip = None
         self.instance_id = None
+        self.features = set()  # optional messages the node has said it understands (heartbeat_containers etc.)
 
     def update_stats(self, new):
         self.perf_counters = new
@@ -41,6 +42,7 @@ class Node(NodeMinimal):
         return {'subnet_id': self.subnet_id,
                 'external_ip': self.external_ip,
                 'instance_id': self.instance_id,
+                'features': sorted(self.features),
                 'pk': b64encode(self.pk).decode(),
                 'weight': self.weight(),
                 'perf_counters': self.perf_counters}
@@ -0,0 +1,86 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Versions for the parts of a resource offer, so offers can be cached and sent as deltas"""
+
+# An offer has four sections: nodes, volumes, externals (tagged containers) and domains. Nodes, and the domains
+# that have been made global, are the same for everyone; the rest belong to a user. Whenever the model changes one
+# of these it calls changed(section, user) which stamps the section with the next tick of a clock. A user's offer
+# version is the latest stamp on anything in their offer, so the offer built last time is good until that moves.
+# Versions go out as [epoch, tick]: a client that kept one can ask for just the sections stamped since, and one
+# from before a restart (different epoch) gets everything.
+
+import time
+
+
+class Offers:
+    def __init__(self):
+        self.epoch = int(time.time())
+        self.clock = 0
+        self.shared = {'nodes': 0, 'domains': 0}  # section -> stamp, for what everyone sees
+        self.users = {}  # user pk -> {section: stamp}
+        self.cache = {}  # user pk -> (tick, offer)
+        self.hits = 0
+        self.builds = 0
+
+    def changed(self, section, user=None):
+        self.clock += 1
+        if user is None:
+            self.shared[section] = self.clock
+            return
+        if user not in self.users:
+            self.users[user] = {}
+        self.users[user][section] = self.clock
+
+    def versions(self, user):
+        """section -> stamp for this user's offer"""
+        own = self.users.get(user, {})
+        return {'nodes': self.shared['nodes'],
+                'volumes': own.get('volumes', 0),
+                'externals': own.get('externals', 0),
+                'domains': max(self.shared['domains'], own.get('domains', 0))}
+
+    def offer(self, user, build):
+        """The offer for this user, calling build(user) only if something in it has changed"""
+        tick = max(self.versions(user).values())
+        try:
+            cached_tick, offer = self.cache[user]
+            if cached_tick == tick:
+                self.hits += 1
+                return offer
+        except KeyError:
+            pass
+        offer = build(user)
+        offer['version'] = [self.epoch, tick]
+        self.cache[user] = (tick, offer)
+        self.builds += 1
+        return offer
+
+    def delta(self, user, since, build):
+        """The sections that have changed since the version passed (or all of them if it's not one of ours)"""
+        offer = self.offer(user, build)
+        try:
+            epoch, tick = since
+        except (TypeError, ValueError):
+            return offer
+        if epoch != self.epoch:
+            return offer
+        rtn = {section: offer[section] for section, stamp in self.versions(user).items() if stamp > tick}
+        rtn['version'] = offer['version']
+        return rtn
+
+    def state(self):
+        return {'epoch': self.epoch, 'clock': self.clock, 'cached': len(self.cache),
+                'hits': self.hits, 'builds': self.builds}
+
+    def __repr__(self):
+        return "<model.offers.Offers object at %x (clock=%d cached=%d)>" % (id(self), self.clock, len(self.cache))
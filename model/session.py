@@ -12,7 +12,6 @@
 # OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
 """Holder for resources that are held by a session"""
 
-import cbor
 import logging
 import time
 from messidge.broker.bases import SessionMinimal
@@ -31,6 +30,7 @@ class Session(SessionMinimal):
         self.tunnels = {}  # a dict of tunnel_uuid to tunnel object
         self.clusters = {}
         self.last_heartbeat = time.time()
+        self.expiry_timer = None  # set by the controller
 
     def close(self, broker):
         logging.debug("Closing session rid: " + hexlify(self.rid).decode())
@@ -38,6 +38,7 @@ class Session(SessionMinimal):
         if len(self.clusters) != 0:
             for cluster in self.clusters.values():
                 logging.info("...garbage collecting cluster: " + cluster.uuid.decode())
+                broker.model.remove_cluster(cluster)
             self.clusters = {}
             broker.proxy.rebuild()
 
@@ -57,14 +58,10 @@ class Session(SessionMinimal):
                                                                  'inform': False})
             except KeyError:  # the node has not reappeared, we'll assume the container is gone too
                 pass
+            broker.model.release_ip(container.ip)  # not informed, so this is the only chance
+            broker.model.remove_container(container)
         self.dependent_containers = {}
 
-    def binary(self):
-        return cbor.dumps({'pk': self.pk,
-                           'containers': [c.as_dict() for c in self.dependent_containers.values()],
-                           'tunnels': [t.as_dict() for t in self.tunnels.values()],
-                           'clusters': [c.as_dict() for c in self.clusters.values()]})
-
     def state(self):
         return {'pk': b64encode(self.pk).decode(),
                 'since_heartbeat': time.time() - self.last_heartbeat,
@@ -73,22 +70,23 @@ class Session(SessionMinimal):
                 'clusters': {uuid.decode(): c.state() for uuid, c in self.clusters.items()}}
 
     @staticmethod
-    def from_binary(rid, binary):
+    def from_rows(rid, pk, containers, tunnels, clusters):
+        """Reconstruct from the (decoded) rows that were persisted for this session"""
         logging.info("Constructing session: " + hexlify(rid).decode())
-        elements = cbor.loads(binary)
-        sess = Session(rid, elements['pk'])
-        for c in elements['containers']:
+        sess = Session(rid, pk)
+        for c in containers:
             ctr = Container.from_dict(c)
+            ctr.session_rid = rid  # may have been persisted before the session was recovered onto a new rid
             sess.dependent_containers[ctr.uuid] = ctr
-            logging.info("...dependent container: " + ctr.uuid.decode())
-        for t in elements['tunnels']:
+            logging.debug("...dependent container: " + ctr.uuid.decode())
+        for t in tunnels:
             tun = Tunnel.from_dict(t, sess)
             sess.tunnels[tun.uuid] = tun
-            logging.info("...persisted tunnel: " + tun.uuid.decode())
-        for c in elements['clusters']:
+            logging.debug("...persisted tunnel: " + tun.uuid.decode())
+        for c in clusters:
             clstr = Cluster.from_dict(c, sess.dependent_containers)
             sess.clusters[clstr.uuid] = clstr
-            logging.info("...persisted cluster: " + clstr.uuid.decode())
+            logging.debug("...persisted cluster: " + clstr.uuid.decode())
         return sess
 
     def __repr__(self):
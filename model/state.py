@@ -27,6 +27,7 @@ from awsornot import dynamic_data_or_none, boto_client
 
 class ClusterGlobalState:
     state_mountpoint = '/opt/20ft/laksa/state/'
+    local_state_directory = '/opt/20ft/laksa/local/'  # live databases when the state mountpoint is EFS
 
     def __init__(self, noserver=False):  # noserver implies not spawning the KV server
         self.ssm = KeyValue(ClusterGlobalState.state_mountpoint + 'kvstore', noserver=noserver)
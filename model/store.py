@@ -0,0 +1,205 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""A write-behind sqlite wrapper that group commits, same interface as litecache's SqlCache"""
+
+# litecache commits every mutation as its own transaction, so a burst (session recovery, a node going away) costs
+# a commit - and an fsync over NFS - per statement. Here the writer thread takes the first mutation off the queue,
+# keeps collecting for up to 'interval' seconds (or 'max_batch' statements) and commits the lot as one transaction.
+#
+# Guarantees:
+#   Ordering - mutations are applied in the order mutate was called, within and across batches.
+#   Atomicity - a batch is one transaction, so after a crash the database holds some prefix of the batches that
+#     were queued: never half a batch, never a later batch without an earlier one. What's lost is whatever was
+#     queued but not yet committed, which is at most 'interval' seconds (plus commit time) of mutations.
+#   Failures - each statement runs in its own savepoint, one that fails (e.g. a constraint) is rolled back and
+#     logged without taking the rest of the batch with it.
+#   Reads - query/query_one are synchronous against committed data. They do not see mutations that are still
+#     queued; as with SqlCache, the in-memory model is the authority while running.
+# Given a Journal (see model/journal.py) the database is restored from it on startup and every batch is appended to
+# it before being committed.
+
+import logging
+import sqlite3
+import struct
+import time
+from threading import Thread, Event
+from queue import Queue, Empty
+
+
+class WriteBehindCache:
+    def __init__(self, directory, name, create_sql, *, interval=0.05, max_batch=1024, journal=None):
+        # open or make the database
+        self.name = name
+        self.filename = directory + "/" + name + ".sqlite3"
+        self.interval = interval
+        self.max_batch = max_batch
+        self.journal = journal
+        self.db = None
+        if journal is not None:
+            journal.restore(self.filename)
+        try:
+            self.db = sqlite3.connect('file:%s?nolock=1' % self.filename, uri=True, check_same_thread=False)
+        except BaseException as e:
+            raise RuntimeError("Couldn't open %s.sqlite3: %s" % (name, e))
+
+        # make sure the database has been initialised
+        cursor = self.db.execute("SELECT * FROM sqlite_master WHERE type='table'")
+        if cursor.fetchone() is None:
+            self.db.executescript(create_sql)
+            self.db.commit()
+            logging.info("Created new database: " + name)
+            if journal is not None:
+                journal.checkpoint(self.db)  # the schema isn't in the journal, so it has to be in the snapshot
+        if journal is not None:
+            journal.start()
+
+        # async updates
+        self.commits = 0
+        self.statements = 0
+        self.update_queue = Queue()
+        self.update_thread = Thread(target=self._updates, name='writer-' + name)
+        self.update_thread.start()
+
+    def close(self):
+        logging.debug("Closing: " + self.filename)
+        self.update_queue.put(None)  # commits anything outstanding first
+        self.update_thread.join()
+        self.db.close()
+        logging.debug("Closed: " + self.filename)
+
+    def query(self, sql, params=()):
+        """Synchronously query"""
+        cursor = self.db.execute(sql, params)
+        return cursor.fetchall()
+
+    def query_one(self, sql, params=(), error=b''):
+        """Synchronously query for exactly one row"""
+        cursor = self.db.execute(sql, params)
+        row = cursor.fetchone()
+        if row is None:  # zero rows
+            raise ValueError(error)
+        return row
+
+    def mutate(self, sql, params):
+        """Queue the given SQL and it's parameters to be written to the database"""
+        self.update_queue.put((sql, params))
+
+    def change_counter(self):
+        """sqlite's file change counter, changes with every commit"""
+        with open(self.filename, 'rb') as f:
+            f.seek(24)
+            return struct.unpack('>I', f.read(4))[0]
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far has been committed"""
+        return self.mark().done.wait(timeout)
+
+    def mark(self):
+        """A Mark that's passed once everything queued so far has been committed, without blocking"""
+        mark = Mark()
+        self.update_queue.put(mark)
+        return mark
+
+    def _updates(self):
+        # listens on the queue for SQL to write to the database
+        rw_sql = sqlite3.connect(self.filename, isolation_level=None)  # we manage the transactions
+        closing = False
+        while not closing:
+            batch = []
+            marks = []
+            record = self.update_queue.get()
+            deadline = time.time() + self.interval
+            while True:
+                if record is None:
+                    closing = True
+                    break
+                if isinstance(record, Mark):
+                    marks.append(record)
+                    break  # commit now rather than wait out the interval
+                batch.append(record)
+                if len(batch) >= self.max_batch:
+                    break
+                try:
+                    record = self.update_queue.get(timeout=max(0, deadline - time.time()))
+                except Empty:
+                    break
+
+            if len(batch) != 0:
+                self._commit(rw_sql, batch)
+            if len(marks) != 0:
+                counter = self.change_counter()  # before anything queued behind the marks is committed
+                for mark in marks:
+                    mark.passed(counter)
+
+        if self.journal is not None:
+            self.journal.stop(rw_sql)
+        rw_sql.close()
+        logging.debug("Update thread closed for: " + self.filename)
+
+    def _commit(self, rw_sql, batch):
+        seq = None
+        if self.journal is not None:
+            seq = self.journal.next_seq()
+            self.journal.append(seq, batch)
+        try:
+            rw_sql.execute("BEGIN")
+            apply_batch(rw_sql, self.name, batch)
+            if seq is not None:
+                rw_sql.execute("PRAGMA user_version=%d" % seq)
+            rw_sql.execute("COMMIT")
+        except sqlite3.Error as e:
+            # the whole batch is lost, but the thread (and everything queued behind it) carries on
+            logging.error("Failed committing %d statement(s) to %s: %s" % (len(batch), self.name, str(e)))
+            if rw_sql.in_transaction:
+                rw_sql.execute("ROLLBACK")
+            return
+        self.commits += 1
+        self.statements += len(batch)
+        logging.debug("Committed %d statement(s) to: %s" % (len(batch), self.name))
+        if self.journal is not None and self.journal.needs_checkpoint():
+            self.journal.checkpoint(rw_sql)
+
+    def __repr__(self):
+        return "<model.store.WriteBehindCache object at %x (%s commits=%d statements=%d queued=%d)>" % \
+               (id(self), self.name, self.commits, self.statements, self.update_queue.qsize())
+
+
+class Mark:
+    """A point in the queue of mutations, records the database's change counter once it's been committed up to"""
+    def __init__(self):
+        self.done = Event()
+        self.change_counter = None
+
+    def passed(self, change_counter):
+        self.change_counter = change_counter
+        self.done.set()
+
+    def counter(self, timeout=None):
+        """Block until the mark has been passed, then the change counter at that point (None if timed out)"""
+        self.done.wait(timeout)
+        return self.change_counter
+
+    def __repr__(self):
+        return "<model.store.Mark object at %x (passed=%s)>" % (id(self), self.done.is_set())
+
+
+def apply_batch(rw_sql, name, batch):
+    # each statement in a savepoint so one failing doesn't lose the rest - within the caller's transaction
+    for sql, params in batch:
+        rw_sql.execute("SAVEPOINT statement")
+        try:
+            rw_sql.execute(sql, params)
+        except sqlite3.Error as e:
+            logging.error("Failed updating %s (%s): %s" % (name, str(e), sql))
+            rw_sql.execute("ROLLBACK TO statement")
+        rw_sql.execute("RELEASE statement")
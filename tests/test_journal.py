@@ -0,0 +1,114 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Tests for restoring a journalled database when the broker moves between machines"""
+
+# Two 'machines' each have their own local directory and share a third as the state mount.
+# Run from the repository root: python3 -m unittest tests.test_journal
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from model.journal import Journal
+from model.store import WriteBehindCache
+
+create_sql = "CREATE TABLE things (n INTEGER PRIMARY KEY);"
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.shared = os.path.join(self.directory, 'shared')
+        self.machines = [os.path.join(self.directory, 'a'), os.path.join(self.directory, 'b')]
+        for directory in [self.shared] + self.machines:
+            os.makedirs(directory)
+        self.db = None
+
+    def tearDown(self):
+        if self.db is not None:  # the writer thread would keep the tests running
+            self.close()
+        shutil.rmtree(self.directory)
+
+    def open(self, machine):
+        local = self.machines[machine]
+        self.db = WriteBehindCache(local, 'test', create_sql, journal=Journal(local, self.shared, 'test'))
+        return self.db
+
+    def close(self):
+        self.db.close()
+        self.db = None
+
+    @staticmethod
+    def insert(db, numbers):
+        for n in numbers:
+            db.mutate("INSERT INTO things (n) VALUES (?)", (n, ))
+        db.flush()
+
+    @staticmethod
+    def things(db):
+        return [row[0] for row in db.query("SELECT n FROM things ORDER BY n")]
+
+    def test_moved_back(self):
+        # runs on a, then on b, then back on a - which has to start from what b left on the shared mount
+        db = self.open(0)
+        self.insert(db, range(0, 10))
+        self.close()
+        db = self.open(1)
+        self.insert(db, range(10, 20))
+        self.close()
+        db = self.open(0)
+        self.assertEqual(self.things(db), list(range(0, 20)))
+        self.insert(db, range(20, 30))
+        self.close()
+
+    def test_newer_in_shared_journal(self):
+        # b's machine is lost after shipping its journal but before it could checkpoint
+        db = self.open(0)
+        self.insert(db, range(0, 10))
+        self.close()
+        db = self.open(1)
+        self.insert(db, range(10, 20))
+        db.journal._ship()
+        lost = os.path.join(self.directory, 'lost')
+        shutil.copytree(self.shared, lost)
+        self.close()
+        shutil.rmtree(self.shared)
+        shutil.move(lost, self.shared)
+        self.assertGreater(os.path.getsize(os.path.join(self.shared, 'test.journal')), 0)
+
+        db = self.open(0)
+        self.assertEqual(self.things(db), list(range(0, 20)))
+        self.close()
+
+    def test_local_ahead(self):
+        # the last batches never got shipped, the local copy is the more recent so is kept
+        db = self.open(0)
+        self.insert(db, range(0, 10))
+        self.close()
+        db = self.open(0)
+        self.insert(db, range(10, 20))
+        db.journal.stop()  # ships the journal, without checkpointing
+        open(os.path.join(self.shared, 'test.journal'), 'wb').close()
+        db.journal.stop = lambda rw_sql=None: None
+        self.close()
+
+        db = self.open(0)
+        self.assertEqual(self.things(db), list(range(0, 20)))
+        self.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Stress test for the ProxyReaper: 10k proxies through a tunnel onto a local listener"""
+
+# The listener runs in its own process and holds every connection open, so the only fds in this one are the
+# proxies' own. Needs an fd limit of a little over 10k, which the test raises the soft limit to if the hard allows.
+# Run from the repository root: python3 -m unittest tests.test_proxy_reaper
+
+import os
+import sys
+import json
+import time
+import select
+import socket
+import resource
+import unittest
+from multiprocessing import Process
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller.reactor import Reactor
+from controller.timers import Timers
+from controller.tunnel import Tunnel, ProxyReaper
+
+proxies = 10000
+soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+fds_needed = proxies + 1024
+
+
+def hold_connections(listener):
+    held = []
+    while True:
+        connection, _ = listener.accept()
+        held.append(connection)
+
+
+class Message:
+    def __init__(self, remote_fd, bulk=b''):
+        self.params = {'proxy': remote_fd}
+        self.bulk = bulk
+
+    def reply(self, results=None):
+        raise AssertionError("Proxy failed: " + str(results))
+
+
+class Client:
+    rid = b'\0\0\0\1'
+
+
+class Loop:
+    def __init__(self):
+        self.idle = set()
+
+    def register_on_idle(self, task):
+        self.idle.add(task)
+
+
+class TunnelBroker:
+    """The parts of the broker a tunnel uses, recording what's sent to the client"""
+    def __init__(self, reaper_args):
+        self.loop = Loop()
+        self.reactor = Reactor()
+        self.timers = Timers()
+        self.timers.start(self.loop)
+        self.reaper = ProxyReaper(self.timers, **reaper_args)
+        self.closed = []  # remote fd's the client was told had closed
+
+    def send_cmd(self, rid, command, params, *, bulk=b'', uuid=b''):
+        if command == b'close_proxy':
+            self.closed.append(params['proxy'])
+
+    def run_until(self, predicate, timeout=60):
+        epoll = self.reactor.epoll.fileno()
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            ready, _, _ = select.select([epoll], [], [], 0.05)
+            if len(ready) != 0:
+                self.reactor._events(epoll)
+            self.timers.run_due()
+        return predicate()
+
+
+@unittest.skipIf(hard != resource.RLIM_INFINITY and hard < fds_needed,
+                 "Needs an fd limit of at least %d, the hard limit is %d" % (fds_needed, hard))
+class TestProxyReaper(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, fds_needed), hard))
+
+    @classmethod
+    def tearDownClass(cls):
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def setUp(self):
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(4096)
+        self.server = Process(target=hold_connections, args=(self.listener, ), daemon=True)
+        self.server.start()
+        self.client = Client()  # the tunnel only keeps a weak reference
+        self.tunnel = None
+
+    def tearDown(self):
+        if self.tunnel is not None:
+            self.tunnel.disconnect_all_proxies()
+            self.broker.reactor.stop()
+        self.server.terminate()
+        self.server.join()
+        self.listener.close()
+
+    def open_proxies(self, start, count, **reaper_args):
+        if self.tunnel is None:
+            self.broker = TunnelBroker(reaper_args)
+            self.tunnel = Tunnel(b'stress', self.client, self.broker, self.broker.loop, '127.0.0.1',
+                                 self.listener.getsockname()[1], 30)
+        connects = self.tunnel.connects
+        for remote_fd in range(start, start + count):
+            self.tunnel.forward(Message(remote_fd))
+        self.assertTrue(self.broker.run_until(lambda: self.tunnel.connects == connects + count),
+                        "only %d of %d proxies connected" % (self.tunnel.connects - connects, count))
+
+    def test_max_open(self):
+        self.open_proxies(0, proxies, max_open=proxies)
+        state = self.broker.reaper.state()
+        self.assertEqual(state['open_proxies'], proxies)
+        self.assertEqual(state['max_open'], proxies)
+        self.assertEqual(state['reclaimed'], 0)
+        self.assertGreaterEqual(state['open_fds'], proxies)
+        self.assertLessEqual(state['open_fds'], state['fd_limit'])
+
+        # the first 100 carry some data, so the least recently used are now 100 onwards
+        for remote_fd in range(0, 100):
+            self.tunnel.forward(Message(remote_fd, b'GET / HTTP/1.0\r\n\r\n'))
+        fds = state['open_fds']
+        self.open_proxies(proxies, 500)
+        state = self.broker.reaper.state()
+        self.assertEqual(state['open_proxies'], proxies)
+        self.assertEqual(state['reclaimed'], 500)
+        self.assertEqual(state['reaped_idle'], 0)
+        self.assertEqual(sorted(self.broker.closed), list(range(100, 600)))
+        self.assertEqual(len(self.tunnel.proxies), proxies)
+        self.assertTrue(all(remote_fd in self.tunnel.proxies for remote_fd in range(0, 100)))
+        self.assertLessEqual(state['open_fds'], fds)  # the reclaimed sockets really were closed
+        self.assertEqual(json.loads(json.dumps(state)), state)  # as served on /proxies
+
+    def test_idle(self):
+        self.open_proxies(0, proxies, idle_timeout=1, sweep_interval=0.25, max_open=2 * proxies)
+        self.broker.reaper.start()
+        self.assertEqual(self.broker.reaper.state()['open_proxies'], proxies)
+
+        # the last 1000 are kept busy, the rest go idle
+        def busy():
+            for remote_fd in range(proxies - 1000, proxies):
+                self.tunnel.forward(Message(remote_fd, b'.'))
+            return self.broker.reaper.reaped == proxies - 1000
+        self.assertTrue(self.broker.run_until(busy, timeout=30))
+        state = self.broker.reaper.state()
+        self.assertEqual(state['open_proxies'], 1000)
+        self.assertEqual(state['reaped_idle'], proxies - 1000)
+        self.assertEqual(state['reclaimed'], 0)
+        self.assertEqual(sorted(self.broker.closed), list(range(0, proxies - 1000)))
+        self.assertEqual(sorted(self.tunnel.proxies.keys()), list(range(proxies - 1000, proxies)))
+        self.assertLess(state['open_fds'], 1000 + 64)
+
+        # and once they stop, they go too
+        self.assertTrue(self.broker.run_until(lambda: self.broker.reaper.state()['open_proxies'] == 0, timeout=10))
+        self.assertEqual(self.broker.reaper.state()['reaped_idle'], proxies)
+        self.assertEqual(len(self.tunnel.proxies), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,195 @@
+# Copyright (c) 2016-2018 David Preece - davep@polymath.tech, All rights reserved.
+#
+# Permission to use, copy, modify, and/or distribute this software for any
+# purpose with or without fee is hereby granted.
+#
+# THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES
+# WITH REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF
+# MERCHANTABILITY AND FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR
+# ANY SPECIAL, DIRECT, INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES
+# WHATSOEVER RESULTING FROM LOSS OF USE, DATA OR PROFITS, WHETHER IN AN
+# ACTION OF CONTRACT, NEGLIGENCE OR OTHER TORTIOUS ACTION, ARISING OUT OF
+# OR IN CONNECTION WITH THE USE OR PERFORMANCE OF THIS SOFTWARE.
+"""Tests for the non-blocking TXT resolver, against a DNS server on localhost"""
+
+# Run from the repository root: python3 -m unittest tests.test_resolver
+
+import os
+import sys
+import time
+import select
+import socket
+import unittest
+from threading import Thread
+from DNS import Base, Lib, Type, Class
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from controller.resolver import Resolver
+from controller.timers import Timers
+
+
+class StubServer:
+    """Answers TXT queries over UDP: 'txt.' names get a record, 'missing.' names NXDOMAIN, 'silent.' nothing"""
+    txt_ttl = 60
+    soa_ttl = 10
+
+    def __init__(self):
+        self.skt = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.skt.bind(('127.0.0.1', 0))
+        self.port = self.skt.getsockname()[1]
+        self.queries = []  # names, as they arrive
+        self.delay = 0
+        self.thread = Thread(target=self._serve, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.skt.close()
+
+    def _serve(self):
+        while True:
+            try:
+                data, addr = self.skt.recvfrom(65535)
+            except OSError:
+                return
+            request = Lib.DnsResult(Lib.Munpacker(data), {})
+            name = request.questions[0]['qname']
+            self.queries.append(name)
+            if name.startswith('silent.'):
+                continue
+            time.sleep(self.delay)
+            m = Lib.Mpacker()
+            if name.startswith('txt.'):
+                m.addHeader(request.header['id'], 1, 0, 1, 0, 1, 1, 0, 0, 1, 1, 0, 0)
+                m.addQuestion(name, Type.TXT, Class.IN)
+                m.addTXT(name, Class.IN, StubServer.txt_ttl, ['token-for-' + name])
+            else:
+                m.addHeader(request.header['id'], 1, 0, 1, 0, 1, 1, 0, 3, 1, 0, 1, 0)  # rcode 3 is NXDOMAIN
+                m.addQuestion(name, Type.TXT, Class.IN)
+                m.addSOA('test', Class.IN, StubServer.soa_ttl, 'ns.test', 'hostmaster.test', 1, 3600, 600, 86400,
+                         StubServer.soa_ttl)
+            self.skt.sendto(m.getbuf(), addr)
+
+
+class Loop:
+    """The parts of messidge's loop the resolver and timers use"""
+    def __init__(self):
+        self.exclusive_handlers = {}
+        self.idle = set()
+
+    def register_exclusive(self, fd, handler, comment=None):
+        self.exclusive_handlers[fd] = handler
+
+    def unregister_exclusive(self, fd):
+        del self.exclusive_handlers[fd]
+
+    def register_on_idle(self, task):
+        self.idle.add(task)
+
+    def run_until(self, predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate() and time.time() < deadline:
+            ready, _, _ = select.select(list(self.exclusive_handlers.keys()), [], [], 0.05)
+            for fd in ready:
+                self.exclusive_handlers[fd](fd)
+            for task in set(self.idle):
+                task()
+        return predicate()
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.server = StubServer()
+        self.defaults = (Base.defaults['server'], Base.defaults['port'])
+        Base.defaults['server'] = ['127.0.0.1']
+        Base.defaults['port'] = self.server.port
+        self.loop = Loop()
+        self.timers = Timers()
+        self.timers.start(self.loop)
+        self.resolver = Resolver(self.timers, timeout=0.3)
+        self.resolver.start(self.loop)
+        self.results = []
+
+    def tearDown(self):
+        self.resolver.stop()
+        self.server.stop()
+        Base.defaults['server'], Base.defaults['port'] = self.defaults
+
+    def callback(self, records, error):
+        self.results.append((records, error))
+
+    def test_answer(self):
+        self.resolver.txt('txt.example.com', self.callback)
+        self.assertEqual(self.results, [])  # didn't block
+        self.assertTrue(self.loop.run_until(lambda: len(self.results) == 1))
+        records, error = self.results[0]
+        self.assertIsNone(error)
+        self.assertEqual(records, [[b'token-for-txt.example.com']])
+
+        # cached for the record's ttl, so the next lookup is answered without a query
+        expires = self.resolver.cache['txt.example.com'][0]
+        self.assertAlmostEqual(expires, time.time() + StubServer.txt_ttl, delta=2)
+        self.resolver.txt('txt.example.com', self.callback)
+        self.assertEqual(self.results[1], self.results[0])
+        self.assertEqual(self.server.queries, ['txt.example.com'])
+        self.assertEqual(self.loop.exclusive_handlers, {})
+
+    def test_nxdomain_negative_ttl(self):
+        self.resolver.txt('missing.example.com', self.callback)
+        self.assertTrue(self.loop.run_until(lambda: len(self.results) == 1))
+        records, error = self.results[0]
+        self.assertEqual(records, [])
+        self.assertIn('NXDOMAIN', error)
+
+        # cached for the SOA's ttl, shorter than the resolver's own negative ttl
+        expires = self.resolver.cache['missing.example.com'][0]
+        self.assertAlmostEqual(expires, time.time() + StubServer.soa_ttl, delta=2)
+        self.resolver.txt('missing.example.com', self.callback)
+        self.assertEqual(self.results[1], self.results[0])
+        self.assertEqual(len(self.server.queries), 1)
+
+    def test_negative_ttl_is_capped(self):
+        self.resolver.negative_ttl = 5
+        self.resolver.txt('missing.example.com', self.callback)
+        self.assertTrue(self.loop.run_until(lambda: len(self.results) == 1))
+        self.assertAlmostEqual(self.resolver.cache['missing.example.com'][0], time.time() + 5, delta=2)
+
+    def test_timeout(self):
+        start = time.time()
+        self.resolver.txt('silent.example.com', self.callback)
+        self.assertTrue(self.loop.run_until(lambda: len(self.results) == 1))
+        self.assertGreaterEqual(time.time() - start, 0.3)
+        records, error = self.results[0]
+        self.assertEqual(records, [])
+        self.assertIn('timed out', error)
+
+        # not an answer so not cached, and the socket has gone
+        self.assertNotIn('silent.example.com', self.resolver.cache)
+        self.assertEqual(self.resolver.queries, {})
+        self.assertEqual(self.loop.exclusive_handlers, {})
+        self.assertEqual(len(self.timers), 0)
+
+    def test_shared_in_flight(self):
+        self.server.delay = 0.1  # so the second lookup is made while the first is in flight
+        other = []
+        self.resolver.txt('txt.shared.com', self.callback)
+        self.resolver.txt('txt.shared.com', lambda records, error: other.append((records, error)))
+        self.resolver.txt('missing.shared.com', self.callback)
+        self.assertEqual(len(self.resolver.queries), 2)
+        self.assertTrue(self.loop.run_until(lambda: len(self.results) == 2 and len(other) == 1))
+        self.assertEqual(sorted(self.server.queries), ['missing.shared.com', 'txt.shared.com'])
+        self.assertIn(([[b'token-for-txt.shared.com']], None), self.results)
+        self.assertEqual(other, [([[b'token-for-txt.shared.com']], None)])
+        self.assertEqual(self.resolver.callbacks, {})
+
+    def test_callback_raising(self):
+        # doesn't stop the other callbacks for the same name
+        def raises(records, error):
+            raise RuntimeError("callback failed")
+        self.resolver.txt('txt.raises.com', raises)
+        self.resolver.txt('txt.raises.com', self.callback)
+        self.assertTrue(self.loop.run_until(lambda: len(self.results) == 1))
+        self.assertIsNone(self.results[0][1])
+
+
+if __name__ == '__main__':
+    unittest.main()